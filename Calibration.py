@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# import normal packages
+import math
+import time
+from bisect import bisect_right
+
+CALIBRATIONBINS = 20        # number of limit bins over the maximum power
+CALIBRATIONMINSAMPLES = 3   # samples required before a bin is used for the curve
+CALIBRATIONSETTLETIME = 8   # seconds after the ack before the output is sampled
+CALIBRATIONWEIGHT = 0.2     # weight of a new sample in the bin average
+
+
+################################################################################
+#                                                                              #
+#   Calibration curve                                                          #
+#                                                                              #
+################################################################################
+
+class CalibrationCurve:
+
+  def __init__(self, points):
+    # points: [[set, measured], ...], sorted by set power
+    self._set = [p[0] for p in points]
+    self._measured = [p[1] for p in points]
+    self._setSlopes = []
+    self._measuredSlopes = []
+    for i in range(0, len(points)-1):
+      dSet = self._set[i+1] - self._set[i]
+      dMeasured = self._measured[i+1] - self._measured[i]
+      self._setSlopes.append(dSet / dMeasured if dMeasured != 0 else 0)
+      self._measuredSlopes.append(dMeasured / dSet if dSet != 0 else 0)
+
+
+  def __len__(self):
+    return len(self._set)
+
+
+  def setPower(self, measuredPower):
+    # limit that has to be sent to get measuredPower at the output
+    i = self._segment(self._measured, measuredPower)
+    return (measuredPower - self._measured[i]) * self._setSlopes[i] + self._set[i]
+
+
+  def measuredPower(self, setPower):
+    # expected output for a limit of setPower
+    i = self._segment(self._set, setPower)
+    return (setPower - self._set[i]) * self._measuredSlopes[i] + self._measured[i]
+
+
+  def _segment(self, values, value):
+    # segment index, the outer segments are extrapolated
+    i = bisect_right(values, value) - 1
+    return min(max(i, 0), len(values) - 2)
+
+
+  def points(self):
+    return list(zip(self._set, self._measured))
+
+
+  def toString(self):
+    return ','.join('%d:%d' % (s, m) for s, m in self.points())
+
+
+################################################################################
+#                                                                              #
+#   Auto calibration                                                           #
+#                                                                              #
+################################################################################
+
+class AutoCalibration:
+
+  def __init__(self, maxPower, learned=None):
+    self._maxPower = maxPower
+    self._bins = [None] * CALIBRATIONBINS
+    self._pendingLimit = None
+    self._ackTime = None
+    self._lastPower = None
+    self._errorSquare = None
+    self.samples = 0
+    self.fitError = 0
+    self.curve = None
+    self.changed = False
+
+    if learned is not None and len(learned) >= 2:
+      self.curve = learned
+      for s, m in learned.points():
+        self._addToBin(s, m, CALIBRATIONMINSAMPLES)
+
+
+  def command(self, limit):
+    self._pendingLimit = limit
+    self._ackTime = None
+    self._lastPower = None
+
+
+  def ack(self):
+    if self._pendingLimit is not None:
+      self._ackTime = time.monotonic()
+
+
+  def power(self, power):
+    if self._maxPower <= 0 or self._ackTime is None or time.monotonic() - self._ackTime < CALIBRATIONSETTLETIME:
+      return
+
+    # wait for two consecutive readings that agree before taking the sample
+    if self._lastPower is None or abs(power - self._lastPower) > max(2, power * 0.02):
+      self._lastPower = power
+      return
+
+    limit = self._pendingLimit
+    power = (power + self._lastPower) / 2
+    self._pendingLimit = None
+    self._ackTime = None
+    self._lastPower = None
+
+    # outside of the regulation range, e.g. DC limited or inverter off
+    if power <= 0 or abs(power - limit) > limit * 0.3:
+      return
+
+    if self.curve is not None:
+      # exponential mean, so the error follows the fit of the current curve
+      error = (power - self.curve.measuredPower(limit)) ** 2
+      if self._errorSquare is None:
+        self._errorSquare = error
+      else:
+        self._errorSquare += (error - self._errorSquare) * CALIBRATIONWEIGHT
+      self.fitError = round(math.sqrt(self._errorSquare), 1)
+
+    self.samples += 1
+    self._addToBin(limit, power, 1)
+    self._fit()
+
+
+  def _addToBin(self, limit, power, count):
+    if self._maxPower <= 0:
+      return
+    i = min(max(int(limit * CALIBRATIONBINS / self._maxPower), 0), CALIBRATIONBINS - 1)
+    b = self._bins[i]
+    if b is None:
+      self._bins[i] = [limit, power, count]
+    else:
+      b[0] += (limit - b[0]) * CALIBRATIONWEIGHT
+      b[1] += (power - b[1]) * CALIBRATIONWEIGHT
+      b[2] += count
+
+
+  def _fit(self):
+    points = [[b[0], b[1], 1] for b in self._bins if b is not None and b[2] >= CALIBRATIONMINSAMPLES]
+    if len(points) < 2:
+      return
+
+    # pool adjacent violators, the output has to rise with the limit
+    pooled = []
+    for p in points:
+      pooled.append(p)
+      while len(pooled) >= 2 and pooled[-2][1] >= pooled[-1][1]:
+        hi = pooled.pop()
+        lo = pooled.pop()
+        w = lo[2] + hi[2]
+        pooled.append([(lo[0]*lo[2] + hi[0]*hi[2]) / w, (lo[1]*lo[2] + hi[1]*hi[2]) / w, w])
+
+    if len(pooled) < 2:
+      return
+
+    curve = CalibrationCurve([[int(round(p[0])), int(round(p[1]))] for p in pooled])
+    if self.curve is None or curve.toString() != self.curve.toString():
+      self.curve = curve
+      self.changed = True
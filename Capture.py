@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import os
+import struct
+
+# file: CAPTUREMAGIC followed by records
+# record: monotonic time, direction, topic length, payload length, topic, payload
+CAPTUREMAGIC = b'HMCAP1\n'
+CAPTURERECORD = struct.Struct('<dBHI')
+CAPTUREIN = 0
+CAPTUREOUT = 1
+
+
+################################################################################
+#                                                                              #
+#   Capture                                                                    #
+#                                                                              #
+################################################################################
+
+class CaptureWriter:
+
+  def __init__(self, filename, maxSize):
+    # maxSize in bytes, the previous file is kept as <filename>.1
+    self._filename = filename
+    self._maxSize = maxSize
+    self._file = None
+    self._size = 0
+    self.records = 0
+    self._open()
+
+
+  def _open(self):
+    self._file = open(self._filename, 'ab')
+    self._size = self._file.tell()
+    if self._size == 0:
+      self._file.write(CAPTUREMAGIC)
+      self._size = len(CAPTUREMAGIC)
+
+
+  def write(self, time, direction, topic, payload):
+    if self._file is None:
+      return
+    if isinstance(topic, str):
+      topic = topic.encode()
+    if isinstance(payload, str):
+      payload = payload.encode()
+    elif not isinstance(payload, bytes):
+      payload = str(payload).encode()
+    try:
+      if self._size + CAPTURERECORD.size + len(topic) + len(payload) > self._maxSize:
+        self._rotate()
+      self._file.write(CAPTURERECORD.pack(time, direction, len(topic), len(payload)))
+      self._file.write(topic)
+      self._file.write(payload)
+      self._size += CAPTURERECORD.size + len(topic) + len(payload)
+      self.records += 1
+    except Exception as e:
+      logging.exception('Error at %s', 'CaptureWriter.write', exc_info=e)
+      self.close()
+
+
+  def _rotate(self):
+    self._file.close()
+    os.replace(self._filename, self._filename + '.1')
+    self._open()
+
+
+  def flush(self):
+    if self._file is not None:
+      self._file.flush()
+
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+def readCapture(filename):
+  # yields (time, direction, topic, payload)
+  with open(filename, 'rb') as f:
+    if f.read(len(CAPTUREMAGIC)) != CAPTUREMAGIC:
+      raise ValueError('%s is not a capture file' % (filename))
+    while True:
+      header = f.read(CAPTURERECORD.size)
+      if len(header) < CAPTURERECORD.size:
+        return
+      time, direction, topicLength, payloadLength = CAPTURERECORD.unpack(header)
+      topic = f.read(topicLength)
+      payload = f.read(payloadLength)
+      if len(payload) < payloadLength:
+        # truncated last record
+        return
+      yield time, direction, topic.decode(), payload
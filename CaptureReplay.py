@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Replays the inbound messages of an inverter capture on a MQTT broker, e.g.
+#   python3 CaptureReplay.py capture_1.bin --speed 10
+# or prints the capture with --dump.
+
+# import normal packages
+import argparse
+import logging
+import time
+import paho.mqtt
+import paho.mqtt.client as mqtt
+
+from Capture import readCapture, CAPTUREIN
+
+
+def dump(filename):
+  start = None
+  for t, direction, topic, payload in readCapture(filename):
+    if start is None:
+      start = t
+    print('%10.3f %s %s %s' % (t - start, '<' if direction == CAPTUREIN else '>', topic, payload.decode(errors='replace')))
+
+
+def replay(args):
+  if paho.mqtt.__version__[0] > '1':
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id='CaptureReplay')
+  else:
+    client = mqtt.Client('CaptureReplay')
+  client.connect(args.host, args.port)
+  client.loop_start()
+
+  for run in range(args.repeat):
+    start = None
+    wallStart = time.monotonic()
+    count = 0
+    for t, direction, topic, payload in readCapture(args.filename):
+      if direction != CAPTUREIN:
+        continue
+      if start is None:
+        start = t
+      if args.speed > 0:
+        delay = (t - start) / args.speed - (time.monotonic() - wallStart)
+        if delay > 0:
+          time.sleep(delay)
+      info = client.publish(topic, payload)
+      count += 1
+    # the messages are sent by the network loop, wait until the last one is out
+    if count > 0:
+      info.wait_for_publish()
+    duration = time.monotonic() - wallStart
+    logging.info("replayed %d messages in %.1f s (%.1f msg/s)" % (count, duration, count / duration if duration > 0 else 0))
+
+  client.loop_stop()
+  client.disconnect()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replays an inverter MQTT capture')
+  parser.add_argument('filename')
+  parser.add_argument('--host', default='127.0.0.1', help='MQTT broker')
+  parser.add_argument('--port', type=int, default=1883)
+  parser.add_argument('--speed', type=float, default=1, help='replay speed, 0: as fast as possible')
+  parser.add_argument('--repeat', type=int, default=1)
+  parser.add_argument('--dump', action='store_true', help='print the capture instead of replaying it')
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                      datefmt='%Y-%m-%d %H:%M:%S',
+                      level=logging.INFO)
+
+  if args.dump:
+    dump(args.filename)
+  else:
+    replay(args)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Measures the MQTT message handling of HmInverter in messages per second, e.g.
+#   python3 DispatchBenchmark.py --dtu 0 --messages 100000 --batch 14
+# Runs the real HmInverter._drainMQTTQueue with the topic table of _initTopicHandlers and the
+# D-Bus updates of _inverterUpdate. The D-Bus service, the settings and the MQTT client are
+# replaced by stubs, so nothing is registered on the bus and no broker is needed.
+
+# import normal packages
+import argparse
+import json
+import random
+import time
+
+import Inverter
+from Inverter import HmInverter
+
+DTUNAMES = ['Ahoy', 'OpenDTU', 'Ahoy JSON']
+
+
+################################################################################
+#                                                                              #
+#   Stubs                                                                      #
+#                                                                              #
+################################################################################
+
+class ServiceStub(dict):
+  # VeDbusService without D-Bus, the values are kept in the dict
+
+  def add_path(self, path, value, **kwargs):
+    self[path] = value
+
+
+  def register(self):
+    pass
+
+
+  def __del__(self):
+    pass
+
+
+class SettingsStub(dict):
+  # SettingsDevice with the default values
+
+  def __init__(self, bus, supportedSettings, eventCallback):
+    dict.__init__(self, ((setting, values[1]) for setting, values in supportedSettings.items()))
+
+
+class MonitorStub:
+
+  def get_value(self, service, path):
+    return 'UTC' if path == '/Settings/System/TimeZone' else None
+
+
+class ClientStub:
+
+  def publish(self, topic, payload):
+    pass
+
+
+  def disconnect(self):
+    pass
+
+
+class BenchInverter(HmInverter):
+
+  def _init_MQTT(self):
+    self._MQTTclient = ClientStub()
+
+
+def newInverter(dtu, path):
+  Inverter.new_service = lambda *args: ServiceStub()
+  Inverter.SettingsDevice = SettingsStub
+  inverter = BenchInverter(1, object(), MonitorStub())
+  inverter._scheduler.stop()
+  # as after a change of the settings and the MQTT connect
+  inverter.settings['/DTU'] = dtu
+  inverter._inverterPath = inverter.settings['/InverterPath'] = path
+  inverter._initTopicHandlers()
+  # a running inverter, power values are also checked against the limit
+  inverter._dbusservice['/State'] = 2
+  return inverter
+
+
+################################################################################
+#                                                                              #
+#   Messages                                                                   #
+#                                                                              #
+################################################################################
+
+def payload(rnd, data, k, handler):
+  if handler.__name__ != '_onJsonMessage':
+    return str(round(rnd.uniform(0, 600), 1)).encode()
+  # the values of the channel in one JSON object
+  values = {}
+  prefix = k + '/' if k else ''
+  for key in data:
+    if not key.startswith(prefix):
+      continue
+    node = values
+    names = key[len(prefix):].split('/')
+    for name in names[:-1]:
+      node = node.setdefault(name, {})
+    node[names[-1]] = round(rnd.uniform(0, 600), 1)
+  return json.dumps(values).encode()
+
+
+def messages(inverter, count):
+  rnd = random.Random(1)
+  topics = list(inverter._topicHandlers.items())
+  result = []
+  for i in range(0, count):
+    # the topics arrive in the order the DTU publishes them
+    topic, (data, k, handler) = topics[i % len(topics)]
+    result.append((topic, payload(rnd, data, k, handler)))
+  return result
+
+
+################################################################################
+#                                                                              #
+#   Main                                                                       #
+#                                                                              #
+################################################################################
+
+def run(inverter, messages, batch, repeat):
+  best = None
+  for r in range(0, repeat):
+    start = time.perf_counter()
+    for i in range(0, len(messages), batch):
+      now = time.monotonic()
+      # what _on_MQTT_message queues for the main loop
+      for topic, payload in messages[i:i + batch]:
+        inverter._mqttQueue.append((topic, payload, now))
+      inverter._drainMQTTQueue()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return len(messages) / best
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Measures the MQTT message handling of HmInverter')
+  parser.add_argument('--dtu', type=int, default=0, choices=range(0, 3), help='0: Ahoy, 1: OpenDTU, 2: Ahoy JSON')
+  parser.add_argument('--messages', type=int, default=100000, help='messages per run')
+  parser.add_argument('--batch', type=int, default=1, choices=range(1, Inverter.MQTTQUEUESIZE + 1), metavar='1-%d' % (Inverter.MQTTQUEUESIZE),
+                      help='messages per drain of the queue, 1: every message is handled on its own')
+  parser.add_argument('--repeat', type=int, default=5, help='runs, the fastest one is reported')
+  parser.add_argument('--path', default='inverter/HM-600', help='inverter path')
+  args = parser.parse_args()
+
+  inverter = newInverter(args.dtu, args.path)
+  msgs = messages(inverter, args.messages)
+  rate = run(inverter, msgs, args.batch, args.repeat)
+  # only the latest message of a topic in a drain is handled
+  handled = sum(len(set(topic for topic, payload in msgs[i:i + args.batch])) for i in range(0, len(msgs), args.batch))
+  print('%s, %d topics, %d messages, %d per drain, %d handled' % (DTUNAMES[args.dtu], len(inverter._topicHandlers), len(msgs), args.batch, handled))
+  print('%10.0f msg/s, per run %d D-Bus writes, %d suppressed' % (rate, inverter._dbusWritesEmitted / args.repeat, inverter._dbusWritesSuppressed / args.repeat))
+
+
+if __name__ == "__main__":
+  main()
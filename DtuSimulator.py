@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# Simulates Ahoy or OpenDTU with a number of inverters on a MQTT broker, e.g.
+#   python3 DtuSimulator.py --dtu 0 --count 20 --mosquitto
+# Point the inverter settings at the printed paths (InverterPath, DTU, InverterID).
+
+# import normal packages
+import argparse
+import heapq
+import json
+import logging
+import random
+import subprocess
+import sys
+import threading
+import time
+import paho.mqtt
+import paho.mqtt.client as mqtt
+
+DTUNAMES = ['Ahoy', 'OpenDTU', 'Ahoy JSON']
+AHOYINVERTERS = 10    # inverter IDs 0-9 of the driver settings
+
+
+################################################################################
+#                                                                              #
+#   Simulated inverter                                                         #
+#                                                                              #
+################################################################################
+
+class SimInverter:
+
+  def __init__(self, sim, index):
+    self._sim = sim
+    self.id = index
+    self.maxPower = sim.args.max_power
+    self.channels = sim.args.channels
+    self.on = True
+    self.limit = self.maxPower
+    self.power = 0.0
+    self.yieldTotal = 0.0
+    self._lastUpdate = time.monotonic()
+
+    if sim.layout == 0:
+      # an Ahoy DTU has at most AHOYINVERTERS inverters, more inverters get more DTUs
+      dtu = index // AHOYINVERTERS
+      self.id = index % AHOYINVERTERS
+      parent = sim.args.prefix if dtu == 0 else '%s%d' % (sim.args.prefix, dtu)
+      self.path = '%s/HM-%d-%d' % (parent, self.maxPower, index)
+      self.control = {
+        parent + f'/ctrl/limit/{self.id}':   self._onLimit,
+        parent + f'/ctrl/power/{self.id}':   self._onPower,
+        parent + f'/ctrl/restart/{self.id}': self._onRestart,
+      }
+    else:
+      self.path = '%s/%d' % (sim.args.prefix, 114100000000 + index)
+      self.control = {
+        self.path + '/cmd/limit_nonpersistent_absolute': self._onLimit,
+        self.path + '/cmd/power':                        self._onPower,
+        self.path + '/cmd/restart':                      self._onRestart,
+      }
+
+
+  def update(self, now):
+    # ramp the output towards the limit
+    dt = now - self._lastUpdate
+    self._lastUpdate = now
+    target = min(self.limit, self._sim.args.available) if self.on else 0
+    step = self._sim.args.ramp * dt
+    if self.power < target:
+      self.power = min(self.power + step, target)
+    else:
+      self.power = max(self.power - step, target)
+    self.yieldTotal += self.power * dt / 3600000
+
+
+  def values(self):
+    power = round(self.power, 1)
+    voltageAC = round(random.uniform(228, 232), 1)
+    voltageDC = self._sim.args.dc_voltage
+    efficiency = 95.0 if power > 0 else 0
+    powerDC = round(power / 0.95, 1)
+    currentDC = round(powerDC / voltageDC / self.channels, 2)
+    temperature = round(25 + 20 * power / self.maxPower, 1)
+
+    if self._sim.layout == 0:
+      # Ahoy
+      values = {
+        'ch0/P_AC': power,
+        'ch0/U_AC': voltageAC,
+        'ch0/I_AC': round(power / voltageAC, 2),
+        'ch0/P_DC': powerDC,
+        'ch0/F_AC': round(random.uniform(49.98, 50.02), 2),
+        'ch0/YieldTotal': round(self.yieldTotal, 3),
+        'ch0/Efficiency': efficiency,
+        'ch0/Temp': temperature,
+      }
+      for i in range(1, self.channels + 1):
+        values[f'ch{i}/U_DC'] = voltageDC
+        values[f'ch{i}/I_DC'] = currentDC
+    else:
+      # OpenDTU
+      values = {
+        '0/power': power,
+        '0/voltage': voltageAC,
+        '0/current': round(power / voltageAC, 2),
+        '0/powerdc': powerDC,
+        '0/frequency': round(random.uniform(49.98, 50.02), 2),
+        '0/yieldtotal': round(self.yieldTotal, 3),
+        '0/efficiency': efficiency,
+        '0/temperature': temperature,
+      }
+      for i in range(1, self.channels + 1):
+        values[f'{i}/voltage'] = voltageDC
+        values[f'{i}/current'] = currentDC
+    return values
+
+
+  def messages(self):
+    values = self.values()
+    if self._sim.args.dtu < 2:
+      return [(self.path + '/' + k, v) for k, v in values.items()]
+
+    # Ahoy with JSON output: one JSON payload per channel
+    channels = {}
+    for k, v in values.items():
+      channel, name = k.split('/')
+      channels.setdefault(channel, {})[name] = v
+    return [(self.path + '/' + channel, json.dumps(data)) for channel, data in channels.items()]
+
+
+  def _onLimit(self, payload):
+    limit = float(payload.decode().rstrip('W'))
+    self._sim.later(self._sim.radioDelay(), self._applyLimit, limit)
+
+
+  def _applyLimit(self, limit):
+    self.limit = min(max(limit, 0), self.maxPower)
+    if self._sim.layout == 0:
+      self._sim.later(self._sim.args.ack_delay, self._sim.publish, self.path + '/ack_pwr_limit', 1)
+
+
+  def _onPower(self, payload):
+    self._sim.later(self._sim.radioDelay(), setattr, self, 'on', int(payload) == 1)
+
+
+  def _onRestart(self, payload):
+    self._sim.later(self._sim.radioDelay(), setattr, self, 'power', 0.0)
+
+
+################################################################################
+#                                                                              #
+#   Simulated DTU                                                              #
+#                                                                              #
+################################################################################
+
+class DtuSimulator:
+
+  def __init__(self, args):
+    self.args = args
+    self.layout = args.dtu % 2
+    self._queue = []
+    self._lock = threading.Lock()
+    self._sequence = 0
+    self._published = 0
+    self._commands = 0
+    self.inverters = [SimInverter(self, i) for i in range(args.count)]
+    self._control = {}
+    for inverter in self.inverters:
+      self._control.update(inverter.control)
+
+    if paho.mqtt.__version__[0] > '1':
+      self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id='DtuSimulator')
+    else:
+      self._client = mqtt.Client('DtuSimulator')
+    self._client.on_connect = self._on_connect
+    self._client.on_message = self._on_message
+
+
+  def run(self):
+    self._client.connect(self.args.host, self.args.port)
+    self._client.loop_start()
+
+    now = time.monotonic()
+    for i, inverter in enumerate(self.inverters):
+      # spread the inverters over the publish interval
+      self.later(self.args.interval * i / len(self.inverters), self._publishInverter, inverter)
+    self.later(self.args.stats, self._stats, now)
+
+    while True:
+      with self._lock:
+        due = self._queue[0][0] if self._queue else now + 1
+      time.sleep(max(0, min(due - time.monotonic(), 0.1)))
+      now = time.monotonic()
+      while True:
+        with self._lock:
+          if not self._queue or self._queue[0][0] > now:
+            break
+          _, _, callback, args = heapq.heappop(self._queue)
+        callback(*args)
+
+
+  def later(self, delay, callback, *args):
+    with self._lock:
+      self._sequence += 1
+      heapq.heappush(self._queue, (time.monotonic() + delay, self._sequence, callback, args))
+
+
+  def radioDelay(self):
+    return max(0, random.gauss(self.args.latency, self.args.latency / 4))
+
+
+  def publish(self, topic, value):
+    self._client.publish(topic, value)
+    self._published += 1
+
+
+  def _publishInverter(self, inverter):
+    inverter.update(time.monotonic())
+    for topic, value in inverter.messages():
+      self.publish(topic, value)
+    self.later(self.args.interval, self._publishInverter, inverter)
+
+
+  def _stats(self, since):
+    now = time.monotonic()
+    logging.info("published %.1f msg/s, %d commands" % (self._published / (now - since), self._commands))
+    self._published = 0
+    self._commands = 0
+    self.later(self.args.stats, self._stats, now)
+
+
+  def _on_connect(self, client, userdata, flags, rc):
+    logging.info("MQTT connected to %s:%s rc %d" % (self.args.host, self.args.port, rc))
+    for topic in self._control:
+      client.subscribe(topic)
+
+
+  def _on_message(self, client, userdata, msg):
+    handler = self._control.get(msg.topic)
+    if handler is None:
+      return
+    self._commands += 1
+    logging.debug("%s %s" % (msg.topic, msg.payload))
+    try:
+      handler(msg.payload)
+    except Exception as e:
+      logging.exception('Error at %s', msg.topic, exc_info=e)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Simulates a DTU with Hoymiles inverters on a MQTT broker')
+  parser.add_argument('--host', default='127.0.0.1', help='MQTT broker')
+  parser.add_argument('--port', type=int, default=1883)
+  parser.add_argument('--mosquitto', action='store_true', help='start a local mosquitto broker on --port')
+  parser.add_argument('--dtu', type=int, default=0, choices=range(0, 3), help='0: Ahoy, 1: OpenDTU, 2: Ahoy JSON')
+  parser.add_argument('--prefix', default=None, help='topic prefix (default inverter for Ahoy, solar for OpenDTU)')
+  parser.add_argument('--count', type=int, default=1, help='number of inverters')
+  parser.add_argument('--max-power', type=int, default=600)
+  parser.add_argument('--channels', type=int, default=2, choices=range(1, 5))
+  parser.add_argument('--available', type=float, default=10000, help='maximum power the DC side delivers')
+  parser.add_argument('--dc-voltage', type=float, default=52)
+  parser.add_argument('--interval', type=float, default=5, help='publish interval in s')
+  parser.add_argument('--latency', type=float, default=0.5, help='mean radio latency of a command in s')
+  parser.add_argument('--ack-delay', type=float, default=0.2, help='delay of the Ahoy limit ack in s')
+  parser.add_argument('--ramp', type=float, default=100, help='power ramp in W/s')
+  parser.add_argument('--stats', type=float, default=10, help='statistics interval in s')
+  parser.add_argument('--debug', action='store_true')
+  args = parser.parse_args()
+  if args.prefix is None:
+    args.prefix = 'inverter' if args.dtu % 2 == 0 else 'solar'
+
+  logging.basicConfig(format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                      datefmt='%Y-%m-%d %H:%M:%S',
+                      level=logging.DEBUG if args.debug else logging.INFO)
+
+  broker = None
+  if args.mosquitto:
+    broker = subprocess.Popen(['mosquitto', '-p', str(args.port)])
+    time.sleep(0.5)
+
+  sim = DtuSimulator(args)
+  for inverter in sim.inverters:
+    logging.info("%s inverter %d: InverterPath %s, InverterID %d" % (DTUNAMES[args.dtu], inverter.id, inverter.path, inverter.id))
+
+  try:
+    sim.run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if broker is not None:
+      broker.terminate()
+
+
+if __name__ == "__main__":
+  main()
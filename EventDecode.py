@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+# Prints an event dump written by /Trace/EventDump, /Debug/EventDump or SIGUSR1, e.g.
+#   python3 EventDecode.py events_microplus.bin
+
+# import normal packages
+import argparse
+import datetime
+
+from Events import readEvents, EVENTS
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Decodes a control event dump')
+  parser.add_argument('filename', nargs='+')
+  args = parser.parse_args()
+
+  for filename in args.filename:
+    offset, pid, records = readEvents(filename)
+    print('# %s: pid %d, %d events' % (filename, pid, len(records)))
+    for t, event, a, b, c in records:
+      name, names = EVENTS.get(int(event), ('event %d' % (event), ('a', 'b', 'c')))
+      values = ' '.join('%s=%g' % (n, v) for n, v in zip(names, (a, b, c)))
+      print('%s %s %s' % (datetime.datetime.fromtimestamp(t + offset).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], name, values))
+
+
+if __name__ == "__main__":
+  main()
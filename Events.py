@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import os
+import signal
+import struct
+import time
+from array import array
+
+# in-memory ring of control events, written to a file only on request
+# record: monotonic time, event id, three numeric arguments
+EVENTMAGIC = b'HMEVT1\n'
+EVENTHEADER = struct.Struct('<dII')   # wall clock - monotonic, pid, number of records
+EVENTFIELDS = 5
+EVENTRINGSIZE = 4096
+
+EV_SETLIMIT = 1
+EV_SETLIMIT_EXIT = 2
+EV_SETLIMIT_NOCHANGE = 3
+EV_SETLIMIT_NODEVICE = 4
+EV_SETPOWERLIMIT = 5
+EV_ACPOWERSETPOINT = 6
+EV_MAXFEEDINPOWER = 7
+EV_BASELOAD_LIMIT = 8
+EV_INVERTER_LIMIT = 9
+EV_INVERTER_SETLIMIT = 10
+EV_INVERTER_SETPOWER = 11
+
+# id: (name, argument names)
+EVENTS = {
+  EV_SETLIMIT:            ('setLimit', ('newLimit', 'maxFeedInPower')),
+  EV_SETLIMIT_EXIT:       ('setLimit exit', ('limitSet',)),
+  EV_SETLIMIT_NOCHANGE:   ('setLimit no change', ('limit',)),
+  EV_SETLIMIT_NODEVICE:   ('setLimit no device', ()),
+  EV_SETPOWERLIMIT:       ('setPowerLimit', ('instance', 'newLimit')),
+  EV_ACPOWERSETPOINT:     ('AcPowerSetpoint', ('setpoint',)),
+  EV_MAXFEEDINPOWER:      ('MaxFeedInPower', ('maxFeedInPower',)),
+  EV_BASELOAD_LIMIT:      ('base load limit', ('step', 'newTarget')),
+  EV_INVERTER_LIMIT:      ('inverter limit changed', ('serial', 'limit')),
+  EV_INVERTER_SETLIMIT:   ('inverterSetLimit', ('serial', 'newLimit')),
+  EV_INVERTER_SETPOWER:   ('inverterSetPower', ('serial', 'old', 'new')),
+}
+
+
+################################################################################
+#                                                                              #
+#   Event ring                                                                 #
+#                                                                              #
+################################################################################
+
+class EventRing:
+
+  def __init__(self, size=EVENTRINGSIZE):
+    # tuples are only packed into the binary format when dumped
+    self._records = [None] * size
+    self._size = size
+    self._pos = 0
+
+
+  def record(self, event, a=0, b=0, c=0):
+    i = self._pos
+    self._records[i] = (time.monotonic(), event, a, b, c)
+    i += 1
+    self._pos = i if i < self._size else 0
+
+
+  def dump(self, filename):
+    # oldest record first
+    try:
+      ordered = [r for r in self._records[self._pos:] + self._records[:self._pos] if r is not None]
+      values = array('d')
+      for r in ordered:
+        values.extend(float('nan') if v is None else v for v in r)
+      with open(filename, 'wb') as f:
+        f.write(EVENTMAGIC)
+        f.write(EVENTHEADER.pack(time.time() - time.monotonic(), os.getpid(), len(ordered)))
+        values.tofile(f)
+      logging.info("Events written to %s" % (filename))
+    except Exception as e:
+      logging.exception('Error at %s', 'dump', exc_info=e)
+
+
+def readEvents(filename):
+  # returns wall clock offset, pid and a list of (time, event, a, b, c)
+  with open(filename, 'rb') as f:
+    if f.read(len(EVENTMAGIC)) != EVENTMAGIC:
+      raise ValueError('%s is not an event file' % (filename))
+    offset, pid, records = EVENTHEADER.unpack(f.read(EVENTHEADER.size))
+    values = array('d')
+    values.frombytes(f.read())
+  return offset, pid, [tuple(values[i:i+EVENTFIELDS]) for i in range(0, len(values) - EVENTFIELDS + 1, EVENTFIELDS)]
+
+
+# one ring per process
+events = EventRing()
+
+
+def dumpOnSignal(filename):
+  # kill -USR1 <pid> writes the events of the process
+  signal.signal(signal.SIGUSR1, lambda signum, frame: events.dump(filename))
@@ -16,30 +16,37 @@ except:
   import _thread as thread   # for daemon = True  / Python 3.x
 import dbus
 
-#sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
-#from vedbus import VeDbusService
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
+from vedbus import VeDbusService
 #from settingsdevice import SettingsDevice
 #from dbusmonitor import DbusMonitor
 
+import json
+import multiprocessing
+import platform
+import time
+from collections import deque
 
-from multiprocessing import Process
-
-from Inverter import HmInverter
+from Inverter import HmInverter, InverterHost, dbusconnection
 from MicroPlus import MicroPlus
+from Metrics import Metrics, MetricsServer, METRICSDIR, processRss, readProcessMetrics
+from Events import dumpOnSignal
+from LogWriter import startLogWriter, initProcessLogging, logConfig
 EXTINFO = 15
 
-#class SystemBus(dbus.bus.BusConnection):
-#    def __new__(cls):
-#        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SYSTEM)
-
-
-#class SessionBus(dbus.bus.BusConnection):
-#    def __new__(cls):
-#        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
+RESTARTBACKOFFMIN = 1     # seconds, the first restart after a stable run is immediate
+RESTARTBACKOFFMAX = 300
+RESTARTSTABLE = 600       # a process running this long resets the backoff
+CRASHLOOPCOUNT = 5        # exits within CRASHLOOPWINDOW seconds open the crash loop breaker
+CRASHLOOPWINDOW = 600
+CRASHLOOPPAUSE = 1800     # seconds until a process is started again after a crash loop
+RESTARTHISTORY = 10
+PROCESSSTATES = ['Stopped', 'Running', 'Waiting', 'Crash loop']
 
-
-#def dbusconnection():
-#    return SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else SystemBus()
+# the supervisor owns a D-Bus connection and GLib sources, children must not inherit them.
+# The forkserver loads the heavy modules once, the children are forked from it.
+_context = multiprocessing.get_context('forkserver')
+_context.set_forkserver_preload(['Preload'])
 
 def getConfig():
   config = configparser.ConfigParser()
@@ -49,75 +56,262 @@ def getConfig():
 
 class clsProcess:
   serial = 0
+  name = ''
   target = None
+  args = ()
   process = None
+  restarts = 0
+  state = 0
+  startTime = None
+  exitCode = None
+  failures = 0
+  exits = None
+  history = None
+  timer = None
+
+
+################################################################################
+#                                                                              #
+#   Child processes                                                            #
+#                                                                              #
+################################################################################
+
+def _exitWithParent():
+  # children of the forkserver are not stopped together with the supervisor
+  parent = multiprocessing.parent_process()
+  if parent is not None:
+    gobject.io_add_watch(parent.sentinel, gobject.PRIORITY_DEFAULT, gobject.IO_IN | gobject.IO_HUP, lambda *args: os._exit(0))
+
+
+def _startInverter(logConfig, serial):
+  try:
+    initProcessLogging(logConfig)
+    from dbus.mainloop.glib import DBusGMainLoop
+    DBusGMainLoop(set_as_default=True)
+    dumpOnSignal("%s/events_%s.bin" % (os.path.dirname(os.path.realpath(__file__)), serial))
+    newDevice = HmInverter(serial)
+    _exitWithParent()
+    mainloop = gobject.MainLoop()
+    mainloop.run()
+
+  except Exception as e:
+    pass
+    logging.critical('Error at %s', 'main', exc_info=e)
+
 
+def _startInverterHost(logConfig, serials):
+  try:
+    initProcessLogging(logConfig)
+    from dbus.mainloop.glib import DBusGMainLoop
+    DBusGMainLoop(set_as_default=True)
+    dumpOnSignal("%s/events_host.bin" % (os.path.dirname(os.path.realpath(__file__))))
+    host = InverterHost(serials)
+    _exitWithParent()
+    mainloop = gobject.MainLoop()
+    mainloop.run()
+
+  except Exception as e:
+    pass
+    logging.critical('Error at %s', 'main', exc_info=e)
+
+
+def _startVebus(logConfig, serial):
+  try:
+    initProcessLogging(logConfig)
+    from dbus.mainloop.glib import DBusGMainLoop
+    DBusGMainLoop(set_as_default=True)
+    dumpOnSignal("%s/events_microplus.bin" % (os.path.dirname(os.path.realpath(__file__))))
+    newDevice = MicroPlus()
+    _exitWithParent()
+    mainloop = gobject.MainLoop()
+    mainloop.run()
+
+  except Exception as e:
+    pass
+    logging.critical('Error at %s', 'main', exc_info=e)
+
+
+################################################################################
+#                                                                              #
+#   Supervisor                                                                 #
+#                                                                              #
+################################################################################
 
 class mainControl:
 
   def __init__(self):
     self.config = self._getConfig()
     self.procs = []
+    self._dbusservice = None
 
     if self.config.has_option('DEFAULT', 'InverterCount') == True:
       InverterCount = int(self.config["DEFAULT"]["InverterCount"])
     else:
       InverterCount = 1
 
-    for i in range(1, InverterCount+1):
-      proc = clsProcess()
-      proc.serial = i
-      proc.target = self._startInverter
-      proc.process = Process(target=proc.target, args=(proc.serial,))
-      self.procs.append(proc)
+    if self.config.has_option('DEFAULT', 'SharedProcess') == True:
+      sharedProcess = int(self.config["DEFAULT"]["SharedProcess"])
+    else:
+      sharedProcess = 0
+
+    if sharedProcess == 1:
+      # all inverters in one process
+      self._addProcess(1, 'host', _startInverterHost, (list(range(1, InverterCount+1)),))
+    else:
+      for i in range(1, InverterCount+1):
+        self._addProcess(i, 'inverter%d' % (i), _startInverter, (i,))
 
-    proc = clsProcess()
-    proc.serial = 0
-    proc.target = self._startVebus
-    proc.process = Process(target=proc.target, args=(proc.serial,))
-    self.procs.append(proc)
+    self._addProcess(0, 'microplus', _startVebus, (0,))
+
+    if self.config.has_option('DEFAULT', 'MetricsPort') == True:
+      self._initMetrics(int(self.config["DEFAULT"]["MetricsPort"]))
 
+    self._initDbus()
     gobject.timeout_add_seconds(1, self._start)
 
 
-  def _startInverter(self,serial):
-    try:
-      newDevice = HmInverter(serial)
-      mainloop = gobject.MainLoop()
-      mainloop.run()
-    
-    except Exception as e:
-      pass
-      logging.critical('Error at %s', 'main', exc_info=e)
+  def _addProcess(self, serial, name, target, args):
+    proc = clsProcess()
+    proc.serial = serial
+    proc.name = name
+    proc.target = target
+    proc.args = (logConfig(),) + args
+    proc.exits = deque(maxlen=CRASHLOOPCOUNT)
+    proc.history = deque(maxlen=RESTARTHISTORY)
+    self.procs.append(proc)
 
 
-  def _startVebus(self,serial):
+  def _initDbus(self):
     try:
-      newDevice = MicroPlus()
-      mainloop = gobject.MainLoop()
-      mainloop.run()
-    
+      self._dbusservice = VeDbusService('com.victronenergy.hoymiles', dbusconnection(), register=False)
+      self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
+      self._dbusservice.add_path('/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
+      self._dbusservice.add_path('/Mgmt/Connection', 'Supervisor')
+      for proc in self.procs:
+        prefix = '/Process/%s' % (proc.name)
+        self._dbusservice.add_path(prefix + '/State', 0)
+        self._dbusservice.add_path(prefix + '/Pid', None)
+        self._dbusservice.add_path(prefix + '/Uptime', None)
+        self._dbusservice.add_path(prefix + '/Restarts', 0)
+        self._dbusservice.add_path(prefix + '/ExitCode', None)
+        self._dbusservice.add_path(prefix + '/History', '[]')
+      self._dbusservice.register()
     except Exception as e:
-      pass
-      logging.critical('Error at %s', 'main', exc_info=e)
+      self._dbusservice = None
+      logging.exception('Error at %s', '_initDbus', exc_info=e)
+
+
+  def _publish(self, proc):
+    if self._dbusservice is None:
+      return
+    prefix = '/Process/%s' % (proc.name)
+    self._dbusservice[prefix + '/State'] = proc.state
+    self._dbusservice[prefix + '/Pid'] = proc.process.pid if proc.startTime is not None else None
+    self._dbusservice[prefix + '/Uptime'] = int(time.monotonic() - proc.startTime) if proc.startTime is not None else None
+    self._dbusservice[prefix + '/Restarts'] = proc.restarts
+    self._dbusservice[prefix + '/ExitCode'] = proc.exitCode
+    self._dbusservice[prefix + '/History'] = json.dumps(list(proc.history))
 
 
   def _start(self):
     for proc in self.procs:
-        proc.process.start()
+      self._startProcess(proc)
     gobject.timeout_add_seconds(10, self._loop)
     return False
 
 
+  def _startProcess(self, proc):
+    proc.timer = None
+    proc.process = _context.Process(target=proc.target, args=proc.args)
+    proc.process.start()
+    proc.startTime = time.monotonic()
+    proc.state = 1
+    # the sentinel becomes readable as soon as the process has exited
+    gobject.io_add_watch(proc.process.sentinel, gobject.PRIORITY_DEFAULT, gobject.IO_IN | gobject.IO_HUP, self._processExit, proc)
+    self._publish(proc)
+    return False
+
+
+  def _processExit(self, fd, condition, proc):
+    proc.process.join()
+    now = time.monotonic()
+    uptime = now - proc.startTime
+    proc.startTime = None
+    proc.exitCode = proc.process.exitcode
+    proc.restarts += 1
+    proc.history.append([int(time.time()), proc.exitCode, round(uptime, 1)])
+    proc.exits.append(now)
+    self._removeMetrics(proc.process.pid)
+
+    if uptime >= RESTARTSTABLE:
+      proc.failures = 0
+
+    if len(proc.exits) == CRASHLOOPCOUNT and now - proc.exits[0] < CRASHLOOPWINDOW:
+      delay = CRASHLOOPPAUSE
+      proc.state = 3
+      proc.exits.clear()
+      logging.error("Process %s crash loop, %d exits within %d s, restart in %d s, history %s"
+        % (proc.name, CRASHLOOPCOUNT, CRASHLOOPWINDOW, delay, json.dumps(list(proc.history))))
+    else:
+      delay = 0 if proc.failures == 0 else min(RESTARTBACKOFFMIN * 2 ** (proc.failures - 1), RESTARTBACKOFFMAX)
+      proc.state = 2 if delay > 0 else 0
+      logging.warning("Process %s stopped with exit code %s after %.0f s, restart in %d s" % (proc.name, proc.exitCode, uptime, delay))
+    proc.failures += 1
+
+    if delay == 0:
+      self._startProcess(proc)
+    else:
+      proc.timer = gobject.timeout_add_seconds(delay, self._startProcess, proc)
+      self._publish(proc)
+    return False
+
+
   def _loop(self):
     for proc in self.procs:
-      if proc.process.is_alive() == False:
-        logging.warning("Process stoped, restart process %s"% (proc.serial))
-        proc.process = Process(target=proc.target, args=(proc.serial,))
-        proc.process.start()
+      self._publish(proc)
     return True
 
 
+  def _initMetrics(self, port):
+    if port <= 0:
+      return
+    try:
+      os.makedirs(METRICSDIR, exist_ok=True)
+      for filename in os.listdir(METRICSDIR):
+        os.remove(os.path.join(METRICSDIR, filename))
+      MetricsServer(port, self._renderMetrics)
+    except Exception as e:
+      logging.exception('Error at %s', '_initMetrics', exc_info=e)
+
+
+  def _removeMetrics(self, pid):
+    try:
+      os.remove('%s/%d.json' % (METRICSDIR, pid))
+    except Exception:
+      pass
+
+
+  def _renderMetrics(self):
+    # runs in the HTTP server thread
+    metrics = Metrics()
+    metrics.add('hoymiles_process_rss_bytes', 'gauge', 'Resident memory of the process', processRss(), process='supervisor')
+    for proc in list(self.procs):
+      if proc.process is None:
+        continue
+      pid = proc.process.pid
+      metrics.add('hoymiles_process_restarts', 'counter', 'Restarts of the process', proc.restarts, process=proc.name)
+      metrics.add('hoymiles_process_up', 'gauge', '1 if the process is running', 1 if proc.startTime is not None else 0, process=proc.name)
+      if proc.exitCode is not None:
+        metrics.add('hoymiles_process_exit_code', 'gauge', 'Exit code of the last run of the process', proc.exitCode, process=proc.name)
+      if pid is None:
+        continue
+      rss = processRss(pid)
+      if rss is not None:
+        metrics.add('hoymiles_process_rss_bytes', 'gauge', 'Resident memory of the process', rss, process=proc.name)
+      metrics.merge(readProcessMetrics(pid), process=proc.name)
+    return metrics.render()
+
+
   def _getConfig(self):
     config = configparser.ConfigParser()
     config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
@@ -133,6 +327,7 @@ class mainControl:
 def main():
   
   thread.daemon = True # allow the program to quit
+  listener = None
 
   try:
       logging.addLevelName(EXTINFO, 'EXTINFO')
@@ -142,14 +337,19 @@ def main():
       else:
         logging_level = logging.INFO
 
-      #configure logging
-      logging.basicConfig(  format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            level=logging_level,
-                            handlers=[
-                                logging.FileHandler("%s/current.log" % (os.path.dirname(os.path.realpath(__file__)))),
-                                logging.StreamHandler()
-                            ])
+      logSize = 1024
+      if config.has_option('DEFAULT', 'LogSize') == True:
+        logSize = int(config["DEFAULT"]["LogSize"])
+      logBackups = 3
+      if config.has_option('DEFAULT', 'LogBackups') == True:
+        logBackups = int(config["DEFAULT"]["LogBackups"])
+      logRate = 20
+      if config.has_option('DEFAULT', 'LogRate') == True:
+        logRate = int(config["DEFAULT"]["LogRate"])
+
+      #configure logging, all processes log through a queue to one writer thread
+      listener = startLogWriter("%s/current.log" % (os.path.dirname(os.path.realpath(__file__))),
+                                logging_level, logSize * 1024, logBackups, logRate, _context)
 
       from dbus.mainloop.glib import DBusGMainLoop
       # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
@@ -167,5 +367,8 @@ def main():
     pass
     logging.critical('Error at %s', 'main', exc_info=e)
 
+  if listener is not None:
+    listener.stop()
+
 if __name__ == "__main__":
   main()
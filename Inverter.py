@@ -12,9 +12,11 @@ else:
     from gi.repository import GLib as gobject
 import sys
 import time
-import paho.mqtt.client as mqtt
 import datetime
-import paho.mqtt
+import json
+import random
+from collections import deque
+from threading import Thread
 
 try:
   import thread   # for daemon = True  / Python 2.x
@@ -29,6 +31,13 @@ from vedbus import VeDbusService
 from settingsdevice import SettingsDevice
 from dbusmonitor import DbusMonitor
 
+from Calibration import CalibrationCurve, AutoCalibration
+from Trace import LatencyTrace, TRACEBUCKETS
+from Scheduler import Scheduler
+from Capture import CaptureWriter, CAPTUREIN, CAPTUREOUT
+from Metrics import processMetrics
+from Events import events, EV_INVERTER_LIMIT, EV_INVERTER_SETLIMIT, EV_INVERTER_SETPOWER
+
 #formatting
 _kwh = lambda p, v: (str(round(v, 2)) + 'KWh')
 _a = lambda p, v: (str(round(v, 1)) + 'A')
@@ -37,11 +46,26 @@ _v = lambda p, v: (str(round(v, 1)) + 'V')
 _hz = lambda p, v: (str(round(v, 1)) + 'Hz')
 _pct = lambda p, v: (str(round(v, 1)) + '%')
 _c = lambda p, v: (str(round(v, 1)) + '°C')
+_mqtt = lambda p, v: (MQTTSTATES[v])
 
 EXTINFO = 15
 
 INVERTERLOOPRATE = 2
 NACKTIMEOUT = 2
+MQTTQUEUESIZE = 512
+LOOPERRORLIMIT = 10
+REINITRETRY = 10      # seconds until a failed reinit is tried again
+LIMITRETRYMIN = 4     # seconds until an unacknowledged limit is sent again
+LIMITRETRYMAX = 64
+LIMITRETRYCOUNT = 5
+POWERRESENDTIME = 30
+POWERRESENDMAX = 480
+STALETIMEOUT = 60     # seconds without a power value until the inverter data is stale
+MQTTBACKOFFMIN = 1    # seconds until the first reconnect attempt
+MQTTBACKOFFMAX = 120
+MQTTSTATES = ['Disconnected', 'Connecting', 'Connected', 'Waiting']
+
+_UNPUBLISHED = object()
 
 class SystemBus(dbus.bus.BusConnection):
     def __new__(cls):
@@ -81,6 +105,20 @@ def new_service(base, type, physical, logical, id, instance):
     return self
 
 
+def inverterDbusMonitor():
+    dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
+    dbus_tree = {
+      'com.victronenergy.settings': { # Not our settings
+        '/Settings/System/TimeZone' : dummy,
+      },
+      'com.victronenergy.system': {
+        '/Serial': dummy,
+        '/VebusService': dummy,
+      },
+    }
+    return DbusMonitor(dbus_tree)
+
+
 ################################################################################
 #                                                                              #
 #   Inverter                                                                   #
@@ -89,23 +127,65 @@ def new_service(base, type, physical, logical, id, instance):
 
 class HmInverter:
 
-  def __init__(self, serial):
+  def __init__(self, serial, dbus=None, dbusmonitor=None):
 
     self.settings = None
-    self._inverterLoopCounter = 0
     self._deviceinstance = 40
     self._role = 'acload'
     self._serial = serial
     self._inverterData = {}
+    self._dataTime = {}
+    self._dataFresh = False
     self._limitDeviationCounter = 0
     self.need_reinit = False
-    self._dbus = dbusconnection()
+    self._dbus = dbus or dbusconnection()
+    self._sharedDbusmonitor = dbusmonitor
+    self._dbusmonitor = None
     self._restartTimer = None
+    self._scheduler = None
+    self._loopErrorCounter = 0
     self._checkState = False
     self._calibrationValues = None
-    self._resendTimeout = 0
+    self._calibrationCurve = None
+    self._autoCalibration = None
+    self._limitInFlight = None
+    self._limitQueued = None
+    self._limitSentTime = 0
+    self._limitRetryDelay = LIMITRETRYMIN
+    self._limitRetries = 0
+    self._limitSuperseded = 0
+    self._limitRetransmitted = 0
+    self._lastPowerCommand = None
+    self._powerRetries = 0
+    self._latencyTrace = LatencyTrace()
+    self._resendTime = 0
     self._dbusservice = None
-    self._ackCounter = 0
+    self._ackTime = 0
+    self._topicHandlers = {}
+    self._publishedValues = {}
+    self._deadbands = {}
+    self._dbusWritesEmitted = 0
+    self._dbusWritesSuppressed = 0
+    self._mqttQueue = deque(maxlen=MQTTQUEUESIZE)
+    self._drainPending = False
+    self._queueDepthMax = 0
+    self._queueDropped = 0
+    self._drainLatencyMax = 0
+    self._mqttConnecting = False
+    self._mqttReconnectPending = False
+    self._mqttState = 0
+    self._mqttFailures = 0
+    self._mqttRetryTimer = None
+    self._mqttReadWatch = None
+    self._mqttWriteWatch = None
+    self._mqttMiscTimer = None
+    self._capture = None
+    self._mqttMessages = 0
+    self._mqttReconnects = 0
+    self._limitSent = 0
+    self._limitAcked = 0
+    self._ackLatencySum = 0
+    processMetrics().register(self._collectMetrics)
     self.init()
     
 
@@ -141,6 +221,10 @@ class HmInverter:
     for i in range(1, 5):
       self._inverterData[1][f'{i}/current'] = 0
 
+    self._topicHandlers = {}
+    self._dataTime = {}
+    self._dataFresh = False
+
     self._initDbusMonitor()
 
     self._init_device_settings()
@@ -153,20 +237,27 @@ class HmInverter:
     base = 'com.victronenergy'
 
     # Create dbus device
-    if self.settings['/DTU'] == 0:
-      dtu = "Ahoy"
-    else:
-      dtu = "OpenDTU"
+    dtu = self._dtuName()
 
     self._dbusservice = new_service(base, self._role, 'DTU', dtu, self._deviceinstance, self._deviceinstance)
+    self._initCapture()
+    self._publishedValues = {}
+    self._initDeadbands()
 
     # Init the inverter
     self._initInverter()
 
     self._init_MQTT()
 
-    # add _inverterLoop function
-    gobject.timeout_add(1000 / INVERTERLOOPRATE, self._inverterLoop) 
+    # add loop tasks, spread the periodic tasks of several inverters
+    phase = (self._serial % 8) * 0.25
+    self._loopErrorCounter = 0
+    self._scheduler = Scheduler(self.settings['/LoopRate'])
+    self._scheduler.every(None, self._inverterLoop)
+    self._scheduler.every(20, self._checkInverterState, phase=phase)
+    self._scheduler.every(60, self._statusLoop, phase=phase, jitter=1)
+    self._scheduler.every(300, self._refreshLoop, phase=phase, jitter=5)
+    self._scheduler.start()
 
     if self._restartTimer is not None:
       gobject.source_remove(self._restartTimer)
@@ -212,6 +303,19 @@ class HmInverter:
       '/DeviceName':                        {'initial': '',       'textformat': None},
       '/Temperature':                       {'initial': 0,        'textformat': _c},
       '/State':                             {'initial': 0,        'textformat': None},
+
+      '/Debug/DbusWritesEmitted':           {'initial': 0,        'textformat': None},
+      '/Debug/DbusWritesSuppressed':        {'initial': 0,        'textformat': None},
+      '/Debug/MqttQueueDepth':              {'initial': 0,        'textformat': None},
+      '/Debug/MqttQueueDropped':            {'initial': 0,        'textformat': None},
+      '/Debug/MqttDrainLatency':            {'initial': 0,        'textformat': None},
+      '/Debug/LimitInFlight':               {'initial': 0,        'textformat': None},
+      '/Debug/LimitSuperseded':             {'initial': 0,        'textformat': None},
+      '/Debug/LimitRetransmitted':          {'initial': 0,        'textformat': None},
+      '/Debug/SchedulerMisses':             {'initial': 0,        'textformat': None},
+      '/DataAge':                           {'initial': None,     'textformat': None},
+      '/Mqtt/State':                        {'initial': 0,        'textformat': _mqtt},
+      '/Mqtt/Failures':                     {'initial': 0,        'textformat': None},
     }
 
     # add path values to dbus
@@ -232,13 +336,23 @@ class HmInverter:
       self._dbusservice.add_path('/Restart', 0, onchangecallback=self._handlechangedvalue,  writeable=True)
       self._dbusservice.add_path('/Ac/CalibrationValues', self.settings['/CalibrationValues'], onchangecallback=self._handlechangedvalue,  writeable=True)
       self._dbusservice.add_path('/Ac/Calibration', self.settings['/Calibration'], onchangecallback=self._handlechangedvalue,  writeable=True)
-      self._calibrationValues = self._getCalibrationArray(self._dbusservice['/Ac/CalibrationValues'])
+      self._dbusservice.add_path('/Ac/AutoCalibration', self.settings['/AutoCalibration'], onchangecallback=self._handlechangedvalue,  writeable=True)
+      self._dbusservice.add_path('/Ac/CalibrationLearned', self.settings['/CalibrationLearned'])
+      self._dbusservice.add_path('/Ac/CalibrationSamples', 0)
+      self._dbusservice.add_path('/Ac/CalibrationFitError', 0, gettextcallback=_w)
+      self._dbusservice.add_path('/Ac/PowerLimitTrace', '', onchangecallback=self._handlechangedvalue,  writeable=True)
+      self._dbusservice.add_path('/Trace/Buckets', TRACEBUCKETS)
+      self._dbusservice.add_path('/Trace/Histogram', self._latencyTrace.histogram())
+      self._dbusservice.add_path('/Trace/Completed', 0)
+      self._dbusservice.add_path('/Trace/Dump', 0, onchangecallback=self._handlechangedvalue,  writeable=True)
+      self._dbusservice.add_path('/Trace/EventDump', 0, onchangecallback=self._handlechangedvalue,  writeable=True)
+      self._setCalibrationValues(self._getCalibrationArray(self._dbusservice['/Ac/CalibrationValues']))
+      self._initAutoCalibration()
       self._dbusservice['/Ac/MaxPower'] = self._getCalibratedMaxPower()
 
     self._dbusservice['/ProductId'] = 0xFFF1
     self._dbusservice['/FirmwareVersion'] = 0x482
     self._dbusservice['/ProductName'] = 'Hoymiles'
-    self._dbusservice['/Connected'] = 1
     self._dbusservice['/Serial'] = self._serial
 
     self._dbusservice.register()
@@ -260,17 +374,31 @@ class HmInverter:
     if self.settings:
         self.settings._settings = None
         self.settings = None
-    self._MQTTclient.loop_stop()
+    if self._capture is not None:
+      self._capture.close()
+      self._capture = None
+    self._MQTT_cancelRetry()
+    self._MQTT_unwatchSocket()
+    # ends the paho thread without waiting for it
     self._MQTTclient.disconnect()
 
 
+  def restart(self):
+    try:
+      self.destroy()
+    except Exception as e:
+      logging.exception('Error at %s', 'restart', exc_info=e)
+    self.need_reinit = True
+
+
   def _customnameChanged(self, path, val):
     self.settings['/Customname'] = val
     return True
 
 
   def _handlechangedvalue(self, path, value):
-    logging.log(EXTINFO,"dbus_value_changed (Inverter %s): %s %s" % (self._serial, path, value,))
+    if path != '/Ac/PowerLimit':
+      logging.log(EXTINFO,"dbus_value_changed (Inverter %s): %s %s" % (self._serial, path, value,))
     if path == '/Position':
       self.settings['/Position'] = value
       return True # accept the change
@@ -289,7 +417,8 @@ class HmInverter:
         retVal = False
         value = self._dbusservice['/Ac/MaxPower']
         self._dbusservice['/Ac/PowerLimit'] = value
-      logging.log(EXTINFO,"Limit %s changed: %s" % (self._serial, value,))
+      events.record(EV_INVERTER_LIMIT, self._serial, value)
+      self._latencyTrace.stamp('delivery', value)
       if self._dbusservice['/State'] >= 1:
         self._inverterSetPower(value)
       return retVal
@@ -306,7 +435,7 @@ class HmInverter:
       if value == '':
         self.settings['/CalibrationValues'] = value
         #logging.log(EXTINFO,"dbus_value_changed: %s %s" % (path, value,))
-        self._calibrationValues = None
+        self._setCalibrationValues(None)
       else:
         array = self._getCalibrationArray(value)
         if array is None:
@@ -314,7 +443,7 @@ class HmInverter:
         else:
           self.settings['/CalibrationValues'] = value
           #logging.log(EXTINFO,"dbus_value_changed: %s %s" % (path, value,))
-          self._calibrationValues = array
+          self._setCalibrationValues(array)
       self._dbusservice['/Ac/MaxPower'] = self._getCalibratedMaxPower()
 
     if path == '/Ac/Calibration':
@@ -322,9 +451,26 @@ class HmInverter:
       self.settings['/Calibration'] = value
       self._dbusservice['/Ac/MaxPower'] = self._getCalibratedMaxPower()
 
+    if path == '/Ac/AutoCalibration':
+      self.settings['/AutoCalibration'] = value
+      self._dbusservice['/Ac/MaxPower'] = self._getCalibratedMaxPower()
+
     if path == '/DisableFeedIn':
       self._checkState = True
 
+    if path == '/Ac/PowerLimitTrace':
+      self._latencyTrace.start(value)
+
+    if path == '/Trace/Dump':
+      if value != 0:
+        self._latencyTrace.dump("%s/trace_%s.csv" % (os.path.dirname(os.path.realpath(__file__)), self._serial))
+        return False
+
+    if path == '/Trace/EventDump':
+      if value != 0:
+        events.dump("%s/events_%s.bin" % (os.path.dirname(os.path.realpath(__file__)), self._serial))
+        return False
+
     if path == '/Restart':
       if value != 0:
         self._inverterRestart()
@@ -334,17 +480,10 @@ class HmInverter:
 
 
   def _initDbusMonitor(self):
-    dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
-    dbus_tree = {
-      'com.victronenergy.settings': { # Not our settings
-        '/Settings/System/TimeZone' : dummy,
-      },
-      'com.victronenergy.system': {
-        '/Serial': dummy,
-        '/VebusService': dummy,
-      },
-    }
-    self._dbusmonitor = DbusMonitor(dbus_tree)
+    if self._sharedDbusmonitor is not None:
+      self._dbusmonitor = self._sharedDbusmonitor
+    elif self._dbusmonitor is None:
+      self._dbusmonitor = inverterDbusMonitor()
 
 
   def _init_device_settings(self):
@@ -364,16 +503,30 @@ class HmInverter:
         '/MqttUser':                      [path + '/MqttUser', '', 0, 0],
         '/MqttPwd':                       [path + '/MqttPwd', '', 0, 0],
         '/InverterPath':                  [path + '/InverterPath', 'inverter/HM-600', 0, 0],
-        '/DTU':                           [path + '/DTU', 0, 0, 1],
+        '/DTU':                           [path + '/DTU', 0, 0, 2],
         '/InverterID':                    [path + '/InverterID', 0, 0, 9],
         '/Enabled':                       [path + '/Enabled', 1, 0, 1],
         '/Position':                      [path + '/Position', 0, 0, 2],
         '/AutoRestart':                   [path + '/AutoRestart', 0, 0, 1],
         '/CalibrationValues':             [path + '/CalibrationValues', '', 0, 0],
         '/Calibration':                   [path + '/Calibration', 0, 0, 1],
+        '/AutoCalibration':               [path + '/AutoCalibration', 0, 0, 1],
+        '/CalibrationLearned':            [path + '/CalibrationLearned', '', 0, 0],
+        '/PowerDeadband':                 [path + '/PowerDeadband', 0.0, 0.0, 50.0],
+        '/VoltageDeadband':               [path + '/VoltageDeadband', 0.0, 0.0, 10.0],
+        '/CurrentDeadband':               [path + '/CurrentDeadband', 0.0, 0.0, 5.0],
+        '/EventUpdate':                   [path + '/EventUpdate', 1, 0, 1],
+        '/MqttLoop':                      [path + '/MqttLoop', 0, 0, 1],
+        '/LoopRate':                      [path + '/LoopRate', INVERTERLOOPRATE, 1, 10],
+        '/StaleTimeout':                  [path + '/StaleTimeout', STALETIMEOUT, 10, 600],
+        '/Capture':                       [path + '/Capture', 0, 0, 1],
+        '/CaptureSize':                   [path + '/CaptureSize', 1024, 16, 65536],
     }
 
     self.settings = SettingsDevice(self._dbus, SETTINGS, self._setting_changed)
+    # the former OpenDTU JSON (3) subscribed to a topic OpenDTU does not publish
+    if self.settings['/DTU'] > 2:
+      self.settings['/DTU'] = 1
     self._role, self._deviceinstance = self.get_role_instance()
 
 
@@ -390,11 +543,13 @@ class HmInverter:
 
     elif setting == '/MaxPower':
       self.settings['/MaxPower'] = newvalue
+      self._initAutoCalibration()
       self._dbusservice['/Ac/MaxPower'] = self._getCalibratedMaxPower()
       self._dbusservice['/Ac/MinPower'] = newvalue * 0.025
       
     elif setting == '/InverterPath':
       self._inverterPath = newvalue
+      self._initTopicHandlers()
       self._MQTT_connect()
     
     elif setting == '/MqttUrl':
@@ -419,16 +574,26 @@ class HmInverter:
         self._checkState = True
 
     elif setting == '/DTU':
-      if self.settings['/DTU'] == 0:
-        self._dbusservice['/Mgmt/Connection'] = "Ahoy"
-      else:
-        self._dbusservice['/Mgmt/Connection'] = "OpenDTU"
+      self._dbusservice['/Mgmt/Connection'] = self._dtuName()
+      self._initTopicHandlers()
       self._MQTT_connect()
 
+    elif setting == '/MqttLoop':
+      self._MQTT_connect()
+
+    elif setting == '/LoopRate':
+      self._scheduler.setRate(newvalue)
+
+    elif setting in {'/PowerDeadband', '/VoltageDeadband', '/CurrentDeadband'}:
+      self._initDeadbands()
+
+    elif setting in {'/Capture', '/CaptureSize'}:
+      self._initCapture()
+
 
   def _checkInverterState(self):
     self._checkState = False
-    if self._role == 'pvinverter':
+    if self._role == 'pvinverter' or not self._dataFresh:
       return
     
     if self._dbusservice['/State'] == 0: # Inverter is switched off
@@ -440,22 +605,23 @@ class HmInverter:
         return
 
       # Switch off inverter again if it is still running
-      if self._dbusservice['/Ac/Power'] > 0 and self._resendTimeout == 0:
+      if self._dbusservice['/Ac/Power'] > 0 and self._resendTime <= time.monotonic():
         self._inverterOff()
 
     else: # Inverter is switched on
       if  self._dbusservice['/State'] == 1:
         #Inverter starts
         if self._dbusservice['/Ac/Power'] == 0:
-          if self._resendTimeout == 0:
+          if self._resendTime <= time.monotonic():
             self._inverterOn()
         else:
           logging.log(EXTINFO,"Inverter %s start complete" % (self._serial))
+          self._lastPowerCommand = None
           self._dbusservice['/State'] = 2
         return
       else:
         # Inverter is running
-        if self._dbusservice['/Ac/Power'] == 0 and self._resendTimeout == 0:
+        if self._dbusservice['/Ac/Power'] == 0 and self._resendTime <= time.monotonic():
           # Restart inverter
           self._inverterOn()
 
@@ -468,23 +634,35 @@ class HmInverter:
 
   def _inverterOn(self):
     logging.log(EXTINFO,"Inverter %s on" % (self._serial))
-    self._MQTTclient.publish(self._inverterControlPath('power'), 1)
-    self._resendTimeout = 60
+    self._inverterPowerCommand(1)
 
 
   def _inverterOff(self):
     logging.log(EXTINFO,"Inverter %s off" % (self._serial))
-    self._MQTTclient.publish(self._inverterControlPath('power'), 0)
-    self._resendTimeout = 60
+    self._inverterPowerCommand(0)
+
+
+  def _inverterPowerCommand(self, on):
+    if not self._dataFresh:
+      logging.log(EXTINFO,"Inverter %s data stale, power command suppressed" % (self._serial))
+      return
+    # repeated identical commands back off exponentially
+    if self._lastPowerCommand == on:
+      self._powerRetries += 1
+    else:
+      self._powerRetries = 0
+    self._lastPowerCommand = on
+    self._MQTT_publish(self._inverterControlPath('power'), on)
+    self._resendTime = time.monotonic() + min(POWERRESENDTIME * 2 ** self._powerRetries, POWERRESENDMAX)
 
 
   def _inverterRestart(self):
     logging.log(EXTINFO,"Inverter %s restart" % (self._serial))
-    self._MQTTclient.publish(self._inverterControlPath('restart'), 1)
+    self._MQTT_publish(self._inverterControlPath('restart'), 1)
 
 
   def _inverterSetLimit(self, newLimit, force=False):
-    logging.log(EXTINFO,"_inverterSetLimit: %s" % (newLimit))
+    events.record(EV_INVERTER_SETLIMIT, self._serial, newLimit)
     if self._dbusservice['/State'] >= 0 or force:
       self._inverterSetPower(newLimit, force)
     self._dbusservice['/Ac/PowerLimit'] = newLimit
@@ -494,60 +672,160 @@ class HmInverter:
     newPower      = max(int(power), self._dbusservice['/Ac/MinPower'])
     currentPower  = int(self._dbusservice['/Ac/PowerLimit'] )
     
-    logging.log(EXTINFO,"_inverterSetPower(%s): old %s, new %s" % (self._serial, currentPower, power))
+    events.record(EV_INVERTER_SETPOWER, self._serial, currentPower, power)
 
     if newPower != currentPower or force == True:
-      self._MQTTclient.publish(self._inverterControlPath('limit'), self._inverterFormatLimit(self._getCalibratedPower(newPower)))
+      self._queueLimit(self._getCalibratedPower(newPower))
       self._limitDeviationCounter = 0
-      self._ackCounter = 0
+      self._ackTime = time.monotonic()
       self._dbusservice['/Ac/PowerLimitAck'] = 0
-      
+
+
+  def _queueLimit(self, limit):
+    # at most one limit in flight, a newer limit replaces the queued one
+    # while the data is stale the limit is held back until the inverter reports again
+    if self._limitInFlight is None and self._dataFresh:
+      self._publishLimit(limit)
+      return
+    if self._limitQueued is not None:
+      self._limitSuperseded += 1
+      self._dbusservice['/Debug/LimitSuperseded'] = self._limitSuperseded
+    self._limitQueued = limit
+
+
+  def _publishLimit(self, limit):
+    self._MQTT_publish(self._inverterControlPath('limit'), self._inverterFormatLimit(limit))
+    self._limitSent += 1
+    self._latencyTrace.stamp('publish')
+    if self._autoCalibration is not None:
+      self._autoCalibration.command(limit)
+    if self._dtuLayout() != 0:
+      # OpenDTU does not acknowledge limits, the calibration settle time starts with the command
+      if self._autoCalibration is not None:
+        self._autoCalibration.ack()
+      return
+    self._limitInFlight = limit
+    self._limitSentTime = time.monotonic()
+    self._limitRetryDelay = LIMITRETRYMIN
+    self._limitRetries = 0
+    self._dbusservice['/Debug/LimitInFlight'] = 1
+
+
+  def _limitAcknowledged(self):
+    self._limitInFlight = None
+    self._dbusservice['/Debug/LimitInFlight'] = 0
+    if self._limitQueued is not None:
+      limit = self._limitQueued
+      self._limitQueued = None
+      self._publishLimit(limit)
+
+
+  def _checkLimitRetransmit(self):
+    if self._limitInFlight is None or not self._dataFresh or time.monotonic() - self._limitSentTime < self._limitRetryDelay:
+      return
+
+    if self._limitQueued is not None:
+      # the unacknowledged limit is outdated, send the newest one instead
+      self._limitSuperseded += 1
+      self._dbusservice['/Debug/LimitSuperseded'] = self._limitSuperseded
+      limit = self._limitQueued
+      self._limitQueued = None
+      self._publishLimit(limit)
+      return
+
+    if self._limitRetries >= LIMITRETRYCOUNT:
+      logging.warning("Inverter %s limit %s not acknowledged" % (self._serial, self._limitInFlight))
+      self._limitInFlight = None
+      self._dbusservice['/Debug/LimitInFlight'] = 0
+      return
+
+    self._limitRetries += 1
+    self._limitRetransmitted += 1
+    self._dbusservice['/Debug/LimitRetransmitted'] = self._limitRetransmitted
+    self._MQTT_publish(self._inverterControlPath('limit'), self._inverterFormatLimit(self._limitInFlight))
+    self._limitSentTime = time.monotonic()
+    self._limitRetryDelay = min(self._limitRetryDelay * 2, LIMITRETRYMAX)
+
 
   def _inverterLoop(self):
     try:
       if self.need_reinit == True:
         self.need_reinit = False
-        self.init()
-        return True
-      
-      # 0.5s interval
-      self._inverterLoopCounter +=1
-      self._inverterUpdate()
+        self._scheduler.stop()
+        # the stopped scheduler does not retry, a failed init is retried by _reinit
+        gobject.idle_add(self._reinit)
+        return
+
+      self._checkFreshness()
+
+      if self.settings['/EventUpdate'] == 0:
+        self._inverterUpdate()
 
-      if self._resendTimeout > 0:
-        self._resendTimeout -= 1
-      
       if self._limitDeviationCounter >= 3:
         logging.log(EXTINFO,"Inverter %s power deviation" % (self._serial))
         self._inverterSetPower(self._dbusservice['/Ac/PowerLimit'], True)
 
+      self._checkLimitRetransmit()
+
       if self._dbusservice['/Ac/PowerLimitAck'] == 0:
-        if self._ackCounter >= INVERTERLOOPRATE * NACKTIMEOUT:
+        if time.monotonic() - self._ackTime >= NACKTIMEOUT:
           self._dbusservice['/Ac/PowerLimitAck'] = 2
-        else:
-          self._ackCounter += 1
 
-      # 20s interval
-      if self._everySeconds(20) or self._checkState:
+      if self._checkState:
         self._checkInverterState()
 
-      # 1min interval
-      if self._everySeconds(60):
-        if self._MQTTclient.is_connected() == False:
-          logging.warning("MQTT not connected, try reconnect (SN:%s)" % (self._serial))
-          self._MQTT_connect()
+      self._loopErrorCounter = 0
 
-      # 5min interval
-      if self._everySeconds(300):
-        self._inverterLoopCounter = 0
+    except Exception as e:
+      logging.exception('Error at %s', '_inverterLoop', exc_info=e)
+      self._loopErrorCounter += 1
+      if self._loopErrorCounter >= LOOPERRORLIMIT:
+        logging.critical("Inverter %s failed %s times, restart inverter" % (self._serial, self._loopErrorCounter))
+        self.restart()
 
-        if self._dbusservice['/State'] > 1 and self._role == 'acload':
-          self._inverterSetPower(self._dbusservice['/Ac/PowerLimit'], True)
 
+  def _reinit(self):
+    try:
+      self.init()
+      logging.info("Inverter %s reinitialized" % (self._serial))
     except Exception as e:
-      logging.exception('Error at %s', '_inverterLoop', exc_info=e)
+      logging.exception('Error at %s', '_reinit', exc_info=e)
+      logging.warning("Inverter %s failed to reinitialize, retry in %ss" % (self._serial, REINITRETRY))
+      if self._scheduler is not None:
+        self._scheduler.stop()
+      try:
+        self.destroy()
+      except Exception as e:
+        logging.exception('Error at %s', '_reinit', exc_info=e)
+      gobject.timeout_add_seconds(REINITRETRY, self._reinit)
+    return False
 
-    return True
+
+  def _statusLoop(self):
+    if self._dbusservice is None:
+      return
+    self._dbusservice['/Debug/DbusWritesEmitted'] = self._dbusWritesEmitted
+    self._dbusservice['/Debug/DbusWritesSuppressed'] = self._dbusWritesSuppressed
+    self._dbusservice['/Debug/MqttQueueDepth'] = self._queueDepthMax
+    self._dbusservice['/Debug/MqttQueueDropped'] = self._queueDropped
+    self._dbusservice['/Debug/MqttDrainLatency'] = round(self._drainLatencyMax * 1000, 1)
+    self._dbusservice['/Debug/SchedulerMisses'] = self._scheduler.taskMisses()
+    self._queueDepthMax = 0
+    self._drainLatencyMax = 0
+    if self._capture is not None:
+      self._capture.flush()
+    if self._mqttState == 0:
+      logging.warning("MQTT not connected, try reconnect (SN:%s)" % (self._serial))
+      self._MQTT_connect()
+
+
+  def _refreshLoop(self):
+    if self._dbusservice is None:
+      return
+    if self._dbusservice['/State'] > 1 and self._role == 'acload':
+      self._inverterSetPower(self._dbusservice['/Ac/PowerLimit'], True)
+
+    self._saveAutoCalibration()
 
 
   def _inverterUpdate(self):
@@ -555,61 +833,70 @@ class HmInverter:
 
       pvinverter_phase = 'L' + str(self.settings['/Phase'])        
 
-      if self.settings['/DTU'] == 0:
+      if not self._dataFresh:
+        return True
+
+      now = time.monotonic()
+      timeout = self.settings['/StaleTimeout']
+      if self._dtuLayout() == 0:
         # Ahoy
-        powerAC     = self._inverterData[0]['ch0/P_AC']
-        voltageAC   = self._inverterData[0]['ch0/U_AC']
-        currentAC   = self._inverterData[0]['ch0/I_AC']
-        frequency   = self._inverterData[0]['ch0/F_AC']
-        yieldTotal  = self._inverterData[0]['ch0/YieldTotal']
-        efficiency  = self._inverterData[0]['ch0/Efficiency']
-        volatageDC  = self._inverterData[0]['ch1/U_DC']
-        powerDC     = self._inverterData[0]['ch0/P_DC']
-        temperature = self._inverterData[0]['ch0/Temp']
+        data = self._inverterData[0]
+        powerAC     = self._value(data, 'ch0/P_AC', now, timeout)
+        voltageAC   = self._value(data, 'ch0/U_AC', now, timeout)
+        currentAC   = self._value(data, 'ch0/I_AC', now, timeout)
+        frequency   = self._value(data, 'ch0/F_AC', now, timeout)
+        yieldTotal  = data['ch0/YieldTotal']
+        efficiency  = self._value(data, 'ch0/Efficiency', now, timeout)
+        volatageDC  = self._value(data, 'ch1/U_DC', now, timeout)
+        powerDC     = self._value(data, 'ch0/P_DC', now, timeout)
+        temperature = self._value(data, 'ch0/Temp', now, timeout)
         currentDC = 0
         for i in range(1, 5):
-          currentDC -= self._inverterData[0][f'ch{i}/I_DC']
+          currentDC -= self._value(data, f'ch{i}/I_DC', now, timeout) or 0
       else:
         # OpenDTU
-        powerAC     = self._inverterData[1]['0/power']
-        voltageAC   = self._inverterData[1]['0/voltage']
-        currentAC   = self._inverterData[1]['0/current']
-        frequency   = self._inverterData[1]['0/frequency']
-        yieldTotal  = self._inverterData[1]['0/yieldtotal']
-        efficiency  = self._inverterData[1]['0/efficiency']
-        volatageDC  = self._inverterData[1]['1/voltage']
-        powerDC     = self._inverterData[1]['0/powerdc']
-        temperature = self._inverterData[1]['0/temperature']
+        data = self._inverterData[1]
+        powerAC     = self._value(data, '0/power', now, timeout)
+        voltageAC   = self._value(data, '0/voltage', now, timeout)
+        currentAC   = self._value(data, '0/current', now, timeout)
+        frequency   = self._value(data, '0/frequency', now, timeout)
+        yieldTotal  = data['0/yieldtotal']
+        efficiency  = self._value(data, '0/efficiency', now, timeout)
+        volatageDC  = self._value(data, '1/voltage', now, timeout)
+        powerDC     = self._value(data, '0/powerdc', now, timeout)
+        temperature = self._value(data, '0/temperature', now, timeout)
         currentDC = 0
         for i in range(1, 5):
-          currentDC -= self._inverterData[1][f'{i}/current']
+          currentDC -= self._value(data, f'{i}/current', now, timeout) or 0
 
       #send data to DBus
       for phase in ['L1', 'L2', 'L3']:
         pre = '/Ac/' + phase
 
         if phase == pvinverter_phase:
-          self._dbusservice[pre + '/Voltage'] = voltageAC
-          self._dbusservice[pre + '/Current'] = currentAC
-          self._dbusservice[pre + '/Power'] = powerAC
-          self._dbusservice[pre + '/Energy/Forward'] = yieldTotal
+          self._publish(pre + '/Voltage', voltageAC)
+          self._publish(pre + '/Current', currentAC)
+          self._publish(pre + '/Power', powerAC)
+          self._publish(pre + '/Energy/Forward', yieldTotal)
 
         else:
-          self._dbusservice[pre + '/Voltage'] = None
-          self._dbusservice[pre + '/Current'] = None
-          self._dbusservice[pre + '/Power'] = None
-          self._dbusservice[pre + '/Energy/Forward'] = None
+          self._publish(pre + '/Voltage', None)
+          self._publish(pre + '/Current', None)
+          self._publish(pre + '/Power', None)
+          self._publish(pre + '/Energy/Forward', None)
 
-      self._dbusservice['/Ac/Power'] = powerAC
-      self._dbusservice['/Ac/Energy/Forward'] = yieldTotal
-      self._dbusservice['/Ac/Efficiency'] = efficiency
-      self._dbusservice['/Ac/Frequency'] = frequency
+      self._publish('/Ac/Power', powerAC)
+      if powerAC is not None:
+        processMetrics().startupDone('inverter %s' % (self._serial), serial=self._serial)
+      self._publish('/Ac/Energy/Forward', yieldTotal)
+      self._publish('/Ac/Efficiency', efficiency)
+      self._publish('/Ac/Frequency', frequency)
 
-      self._dbusservice['/Dc/Current'] = currentDC
-      self._dbusservice['/Dc/Voltage'] = volatageDC
-      self._dbusservice['/Dc/Power'] = powerDC
+      self._publish('/Dc/Current', currentDC)
+      self._publish('/Dc/Voltage', volatageDC)
+      self._publish('/Dc/Power', powerDC)
 
-      self._dbusservice['/Temperature'] = temperature
+      self._publish('/Temperature', temperature)
 
     except Exception as e:
       logging.exception('Error at %s', '_update', exc_info=e)
@@ -617,7 +904,77 @@ class HmInverter:
     return True
 
 
+  def _value(self, data, k, now, timeout):
+    # values that stopped arriving are invalid, values never received keep their initial value
+    t = self._dataTime.get(k)
+    if t is not None and now - t > timeout:
+      return None
+    return data[k]
+
+
+  def _powerKey(self):
+    return 'ch0/P_AC' if self._dtuLayout() == 0 else '0/power'
+
+
+  def _dataAge(self):
+    t = self._dataTime.get(self._powerKey())
+    if t is None:
+      return None
+    return time.monotonic() - t
+
+
+  def _checkFreshness(self):
+    age = self._dataAge()
+    self._publish('/DataAge', None if age is None else int(age))
+    fresh = age is not None and age <= self.settings['/StaleTimeout']
+    if fresh == self._dataFresh:
+      return
+
+    self._dataFresh = fresh
+    self._dbusservice['/Connected'] = 1 if fresh else 0
+    if fresh:
+      logging.info("Inverter %s data received" % (self._serial))
+      if self._limitInFlight is None and self._limitQueued is not None:
+        limit = self._limitQueued
+        self._limitQueued = None
+        self._publishLimit(limit)
+      self._checkState = True
+    else:
+      logging.warning("Inverter %s data stale for %s s" % (self._serial, None if age is None else int(age)))
+      self._limitDeviationCounter = 0
+      for path in ['/Ac/Power', '/Ac/Frequency', '/Ac/Efficiency', '/Dc/Power', '/Dc/Current', '/Dc/Voltage', '/Temperature']:
+        self._publish(path, None)
+      for phase in ['L1', 'L2', 'L3']:
+        for path in ['/Voltage', '/Current', '/Power']:
+          self._publish('/Ac/' + phase + path, None)
+
+
+  def _initDeadbands(self):
+    self._deadbands = {}
+    for path in ['/Ac/Power', '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power', '/Dc/Power']:
+      self._deadbands[path] = self.settings['/PowerDeadband']
+    for path in ['/Ac/L1/Voltage', '/Ac/L2/Voltage', '/Ac/L3/Voltage', '/Dc/Voltage']:
+      self._deadbands[path] = self.settings['/VoltageDeadband']
+    for path in ['/Ac/L1/Current', '/Ac/L2/Current', '/Ac/L3/Current', '/Dc/Current']:
+      self._deadbands[path] = self.settings['/CurrentDeadband']
+
+
+  def _publish(self, path, value):
+    lastValue = self._publishedValues.get(path, _UNPUBLISHED)
+    if lastValue is not _UNPUBLISHED:
+      if value == lastValue or (value is not None and lastValue is not None
+                                and abs(value - lastValue) < self._deadbands.get(path, 0)):
+        self._dbusWritesSuppressed += 1
+        return
+    self._publishedValues[path] = value
+    self._dbusservice[path] = value
+    self._dbusWritesEmitted += 1
+
+
   def _init_MQTT(self):
+    # imported here, the MicroPlus process does not need paho
+    import paho.mqtt
+    import paho.mqtt.client as mqtt
     if paho.mqtt.__version__[0] > '1':
         self._MQTTclient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,client_id=self._MQTTName)
     else:
@@ -625,72 +982,401 @@ class HmInverter:
     self._MQTTclient.on_disconnect = self._on_MQTT_disconnect
     self._MQTTclient.on_connect = self._on_MQTT_connect
     self._MQTTclient.on_message = self._on_MQTT_message
+    self._MQTTclient.on_socket_close = self._on_MQTT_socket_close
+    self._MQTTclient.on_socket_register_write = self._on_MQTT_socket_register_write
+    self._MQTTclient.on_socket_unregister_write = self._on_MQTT_socket_unregister_write
     self._MQTT_connect()
 
 
   def _MQTT_connect(self):
+    # (re)connect with the current settings, never blocks the main loop
+    self._MQTT_cancelRetry()
+    self._mqttFailures = 0
+    self._MQTT_start()
+
+
+  def _MQTT_start(self):
+    self._mqttRetryTimer = None
+    if self._mqttConnecting:
+      # settings changed while a connect is in progress, reconnect afterwards
+      self._mqttReconnectPending = True
+      return False
     try:
-      self._MQTTclient.loop_stop()
+      self._MQTT_unwatchSocket()
       if self.settings['/MqttUser'] != '' and self.settings['/MqttPwd'] != '':
         self._MQTTclient.username_pw_set(self.settings['/MqttUser'], self.settings['/MqttPwd'])
-      rc = self._MQTTclient.connect(self.settings['/MqttUrl'], self.settings['/MqttPort'])  # connect to broker
-      logging.info("MQTT_connect to %s:%s rc %d"% (self.settings['/MqttUrl'], self.settings['/MqttPort'], rc))
-      self._MQTTclient.loop_start()
+      else:
+        self._MQTTclient.username_pw_set(None)
+      self._MQTTclient.connect_async(self.settings['/MqttUrl'], self.settings['/MqttPort'])
     except Exception as e:
       logging.exception("Fehler beim connecten mit Broker")
+      self._MQTT_backoff()
+      return False
+
+    self._mqttConnecting = True
+    self._MQTT_setState(1)
+    # the TCP connect and the name lookup run in a worker thread
+    Thread(target=self._MQTT_connectWorker, args=(self._MQTTclient, self.settings['/MqttUrl'], self.settings['/MqttPort']), daemon=True).start()
+    return False
+
+
+  def _MQTT_connectWorker(self, client, url, port):
+    rc = None
+    try:
+      client.loop_stop()
+      rc = client.reconnect()
+      logging.info("MQTT_connect to %s:%s rc %d"% (url, port, rc))
+    except Exception as e:
+      logging.warning("MQTT connect to %s:%s failed: %s" % (url, port, e))
+    gobject.idle_add(self._MQTT_connectDone, client, rc)
+
+
+  def _MQTT_connectDone(self, client, rc):
+    if client is not self._MQTTclient:
+      # client was replaced by a restart
+      client.disconnect()
+      return False
+    self._mqttConnecting = False
+    if self._mqttReconnectPending:
+      self._mqttReconnectPending = False
+      self._MQTT_start()
+      return False
+    if rc != 0:
+      self._MQTT_backoff()
+      return False
+
+    if self.settings['/MqttLoop'] == 1:
+      # paho is driven by GLib io watches
+      self._MQTT_watchSocket()
+    else:
+      self._MQTTclient.loop_start()
+    return False
+
+
+  def _MQTT_backoff(self):
+    # exponential backoff with jitter, several inverters do not retry in lockstep
+    self._mqttFailures += 1
+    self._mqttReconnects += 1
+    delay = min(MQTTBACKOFFMIN * 2 ** (self._mqttFailures - 1), MQTTBACKOFFMAX)
+    delay = random.uniform(delay / 2, delay)
+    logging.warning("MQTT reconnect in %.1f s (SN:%s, failures %d)" % (delay, self._serial, self._mqttFailures))
+    self._MQTT_cancelRetry()
+    self._mqttRetryTimer = gobject.timeout_add(int(delay * 1000), self._MQTT_start)
+    self._MQTT_setState(3)
+
+
+  def _MQTT_cancelRetry(self):
+    if self._mqttRetryTimer is not None:
+      gobject.source_remove(self._mqttRetryTimer)
+      self._mqttRetryTimer = None
+
+
+  def _MQTT_setState(self, state):
+    self._mqttState = state
+    if self._dbusservice is not None:
+      self._dbusservice['/Mqtt/State'] = state
+      self._dbusservice['/Mqtt/Failures'] = self._mqttFailures
+
+
+  def _MQTT_connected(self, client, rc):
+    if client is not self._MQTTclient:
+      return False
+    if rc == 0:
+      self._mqttFailures = 0
+      self._MQTT_setState(2)
+    else:
+      logging.warning("MQTT failed to connect, return code %d", rc)
+      self._MQTT_unwatchSocket()
+      self._MQTTclient.disconnect()
+      self._MQTT_backoff()
+    return False
+
+
+  def _MQTT_lost(self, client):
+    if client is not self._MQTTclient or self._mqttConnecting:
+      return False
+    self._MQTT_unwatchSocket()
+    self._MQTT_backoff()
+    return False
+
+
+  def _MQTT_watchSocket(self):
+    self._MQTT_unwatchSocket()
+    sock = self._MQTTclient.socket()
+    if sock is None:
+      return
+    self._mqttReadWatch = gobject.io_add_watch(sock.fileno(), gobject.PRIORITY_DEFAULT,
+      gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP, self._MQTT_onReadable)
+    if self._MQTTclient.want_write():
+      self._on_MQTT_socket_register_write(self._MQTTclient, None, sock)
+    self._mqttMiscTimer = gobject.timeout_add_seconds(1, self._MQTT_onMisc)
+
+
+  def _MQTT_unwatchSocket(self):
+    for source in [self._mqttReadWatch, self._mqttWriteWatch, self._mqttMiscTimer]:
+      if source is not None:
+        gobject.source_remove(source)
+    self._mqttReadWatch = None
+    self._mqttWriteWatch = None
+    self._mqttMiscTimer = None
+
+
+  def _MQTT_onReadable(self, fd, condition):
+    self._MQTTclient.loop_read()
+    return self._mqttReadWatch is not None
+
+
+  def _MQTT_onWritable(self, fd, condition):
+    self._MQTTclient.loop_write()
+    return self._mqttWriteWatch is not None
+
+
+  def _MQTT_onMisc(self):
+    self._MQTTclient.loop_misc()
+    return self._mqttMiscTimer is not None
+
+
+  def _on_MQTT_socket_close(self, client, userdata, sock):
+    if self._mqttConnecting:
+      return
+    self._MQTT_unwatchSocket()
+
+
+  def _on_MQTT_socket_register_write(self, client, userdata, sock):
+    if self._mqttConnecting or self._mqttReadWatch is None or self._mqttWriteWatch is not None:
+      return
+    self._mqttWriteWatch = gobject.io_add_watch(sock.fileno(), gobject.PRIORITY_DEFAULT,
+      gobject.IO_OUT, self._MQTT_onWritable)
+
+
+  def _on_MQTT_socket_unregister_write(self, client, userdata, sock):
+    if self._mqttWriteWatch is not None:
+      gobject.source_remove(self._mqttWriteWatch)
+      self._mqttWriteWatch = None
+
+
+  def _MQTT_publish(self, topic, payload):
+    if self._capture is not None:
+      self._capture.write(time.monotonic(), CAPTUREOUT, topic, payload)
+    self._MQTTclient.publish(topic, payload)
+
+
+  def _collectMetrics(self, metrics):
+    if self._dbusservice is None:
+      return
+    serial = self._serial
+    metrics.add('hoymiles_mqtt_messages', 'counter', 'MQTT messages received', self._mqttMessages, serial=serial)
+    metrics.add('hoymiles_mqtt_dropped', 'counter', 'MQTT messages dropped from the full queue', self._queueDropped, serial=serial)
+    metrics.add('hoymiles_mqtt_reconnects', 'counter', 'MQTT reconnect attempts', self._mqttReconnects, serial=serial)
+    metrics.add('hoymiles_mqtt_state', 'gauge', '0: disconnected, 1: connecting, 2: connected, 3: waiting', self._mqttState, serial=serial)
+    metrics.add('hoymiles_dbus_writes', 'counter', 'D-Bus value updates', self._dbusWritesEmitted, serial=serial, result='emitted')
+    metrics.add('hoymiles_dbus_writes', 'counter', 'D-Bus value updates', self._dbusWritesSuppressed, serial=serial, result='suppressed')
+    metrics.add('hoymiles_limit_commands', 'counter', 'Limit commands', self._limitSent, serial=serial, state='sent')
+    metrics.add('hoymiles_limit_commands', 'counter', 'Limit commands', self._limitAcked, serial=serial, state='acked')
+    metrics.add('hoymiles_limit_commands', 'counter', 'Limit commands', self._limitSuperseded, serial=serial, state='superseded')
+    metrics.add('hoymiles_limit_commands', 'counter', 'Limit commands', self._limitRetransmitted, serial=serial, state='retransmitted')
+    metrics.add('hoymiles_limit_ack_seconds', 'summary', 'Time from the limit publish to the DTU ack', (self._ackLatencySum, self._limitAcked), serial=serial)
+    metrics.add('hoymiles_limit_ack_pending', 'gauge', '1 while a limit is not acknowledged', 1 if self._dbusservice['/Ac/PowerLimitAck'] == 0 else 0, serial=serial)
+    metrics.add('hoymiles_scheduler_misses', 'counter', 'Late inverter loop ticks and tasks', self._scheduler.taskMisses(), serial=serial)
+    age = self._dataAge()
+    if age is not None:
+      metrics.add('hoymiles_data_age_seconds', 'gauge', 'Age of the last power value', round(age, 1), serial=serial)
+
+
+  def _initCapture(self):
+    # records the MQTT traffic for CaptureReplay.py
+    if self._capture is not None:
+      self._capture.close()
+      self._capture = None
+    if self.settings['/Capture'] == 1:
+      filename = "%s/capture_%s.bin" % (os.path.dirname(os.path.realpath(__file__)), self._serial)
+      try:
+        self._capture = CaptureWriter(filename, self.settings['/CaptureSize'] * 1024)
+        logging.info("MQTT capture to %s" % (filename))
+      except Exception as e:
+        logging.exception('Error at %s', '_initCapture', exc_info=e)
 
 
   def _on_MQTT_disconnect(self, client, userdata, rc):
     logging.warning("Client Got Disconnected rc %d", rc)
     if rc != 0:
         logging.warning('Unexpected MQTT disconnection. Will auto-reconnect')
-        try:
-          logging.warning("Trying to Reconnect")
-          client.connect(self.settings['/MqttUrl'],self.settings['/MqttPort'])
-        except Exception as e:
-          logging.exception("Fehler beim reconnecten mit Broker")
-          logging.critical("Error in Retrying to Connect with Broker")
-          logging.critical(e)
+        # reconnects are done by the backoff timer, not by the paho thread
+        client.loop_stop()
+        gobject.idle_add(self._MQTT_lost, client)
 
 
   def _on_MQTT_connect(self, client, userdata, flags, rc):
     if rc == 0:
         logging.info("MQTT connected (SN:%s)" % (self._serial))
 
-        for k,v in self._inverterData[self.settings['/DTU']].items():
-          client.subscribe(f'{self._inverterPath}/{k}')
+        self._initTopicHandlers()
+        for topic in self._topicHandlers:
+          client.subscribe(topic)
+
+    gobject.idle_add(self._MQTT_connected, client, rc)
 
+
+  def _initTopicHandlers(self):
+    dtu = self._dtuLayout()
+    data = self._inverterData[dtu]
+    handlers = {}
+    if self.settings['/DTU'] == 2:
+      # Ahoy with JSON output: one JSON payload per channel
+      for i in range(0, 5):
+        handlers[f'{self._inverterPath}/ch{i}'] = (data, f'ch{i}', self._onJsonMessage)
+      handlers[f'{self._inverterPath}/ack_pwr_limit'] = (data, 'ack_pwr_limit', self._onAckMessage)
     else:
-        logging.warning("MQTT failed to connect, return code %d", rc)
-        self._MQTTclient.loop_stop()
-        self._MQTTclient.disconnect()
+      for k in data:
+        if k in {'ch0/P_AC','0/power'}:
+          handler = self._onPowerMessage
+        elif k == 'ack_pwr_limit':
+          handler = self._onAckMessage
+        else:
+          handler = self._onValueMessage
+        handlers[f'{self._inverterPath}/{k}'] = (data, k, handler)
+    self._topicHandlers = handlers
+
+
+  def _dtuLayout(self):
+    # 0: Ahoy topics, 1: OpenDTU topics
+    return self.settings['/DTU'] % 2
+
+
+  def _dtuName(self):
+    return ['Ahoy', 'OpenDTU', 'Ahoy JSON'][self.settings['/DTU']]
 
 
   def _on_MQTT_message(self, client, userdata, msg):
-      logging.debug("MQTT message %s %s" % (msg.topic, msg.payload))
+    # paho network thread: only hand the message over to the main loop
+    if len(self._mqttQueue) == MQTTQUEUESIZE:
+      self._queueDropped += 1
+    self._mqttQueue.append((msg.topic, msg.payload, time.monotonic()))
+    self._mqttMessages += 1
+    if not self._drainPending:
+      self._drainPending = True
+      gobject.idle_add(self._drainMQTTQueue)
+
+
+  def _drainMQTTQueue(self):
+    self._drainPending = False
+    try:
+      depth = len(self._mqttQueue)
+      if depth == 0:
+        return False
+      self._queueDepthMax = max(self._queueDepthMax, depth)
 
-      try:
-        if self._dbusservice is None:
-          return       
-        for k,v in self._inverterData[self.settings['/DTU']].items():
-          if msg.topic == f'{self._inverterPath}/{k}':
-            self._inverterData[self.settings['/DTU']][k] = float(msg.payload)
-            if k in {'ch0/P_AC','0/power'} and self._dbusservice['/State'] >= 1 and self._role == 'acload':
-              deviation = abs(self._dbusservice['/Ac/PowerLimit']-float(msg.payload))
-              if deviation > 50:
-                self._limitDeviationCounter = self._limitDeviationCounter + 1
-              else:
-                self._limitDeviationCounter = 0
-            if k in {'ack_pwr_limit'}:
-              self._dbusservice['/Ac/PowerLimitAck'] = 1
-            return
+      latest = {}
+      oldest = None
+      while True:
+        try:
+          topic, payload, received = self._mqttQueue.popleft()
+        except IndexError:
+          break
+        if oldest is None:
+          oldest = received
+        if self._capture is not None:
+          self._capture.write(received, CAPTUREIN, topic, payload)
+        latest[topic] = (payload, received)
+      self._drainLatencyMax = max(self._drainLatencyMax, time.monotonic() - oldest)
+
+      if self._dbusservice is None:
+        return False
+
+      updated = False
+      for topic, (payload, received) in latest.items():
+        entry = self._topicHandlers.get(topic)
+        if entry is None:
+          continue
+        data, k, handler = entry
+        try:
+          handler(data, k, payload, received)
+          updated = True
+        except Exception as e:
+          logging.exception('Error at %s', '_drainMQTTQueue', exc_info=e)
+
+      if updated:
+        self._checkFreshness()
+        if self.settings['/EventUpdate'] == 1:
+          self._inverterUpdate()
+
+    except Exception as e:
+      logging.exception('Error at %s', '_drainMQTTQueue', exc_info=e)
+
+    return False
 
-      except Exception as e:
-          logging.exception('Error at %s', '_on_MQTT_message', exc_info=e)
+
+  def _onValueMessage(self, data, k, payload, received):
+    data[k] = float(payload)
+    self._dataTime[k] = received
+
+
+  def _onPowerMessage(self, data, k, payload, received):
+    data[k] = float(payload)
+    self._dataTime[k] = received
+    self._checkPowerDeviation(data[k])
+
+
+  def _onAckMessage(self, data, k, payload, received):
+    data[k] = float(payload)
+    self._latencyTrace.stamp('ack')
+    if self._limitInFlight is not None:
+      self._limitAcked += 1
+      self._ackLatencySum += time.monotonic() - self._limitSentTime
+    # acknowledges the limit in flight, before a queued limit replaces it
+    if self._autoCalibration is not None:
+      self._autoCalibration.ack()
+    self._limitAcknowledged()
+    if self._limitInFlight is None:
+      self._dbusservice['/Ac/PowerLimitAck'] = 1
+    else:
+      # the queued limit went out with this ack
+      self._ackTime = time.monotonic()
+
+
+  def _onJsonMessage(self, data, k, payload, received):
+    values = {}
+    self._flattenJson(json.loads(payload), k, values)
+    snapshot = {}
+    for key, value in values.items():
+      if key in data:
+        snapshot[key] = float(value)
+        self._dataTime[key] = received
+    data.update(snapshot)
+    if 'ch0/P_AC' in snapshot:
+      self._checkPowerDeviation(snapshot['ch0/P_AC'])
+
+
+  def _flattenJson(self, value, prefix, values):
+    if isinstance(value, dict):
+      for k, v in value.items():
+        self._flattenJson(v, f'{prefix}/{k}' if prefix else str(k), values)
+    else:
+      values[prefix] = value
+
+
+  def _checkPowerDeviation(self, power):
+    if self._autoCalibration is not None and self._role == 'acload':
+      samples = self._autoCalibration.samples
+      self._autoCalibration.power(power)
+      if self._autoCalibration.samples != samples:
+        self._dbusservice['/Ac/CalibrationSamples'] = self._autoCalibration.samples
+        self._dbusservice['/Ac/CalibrationFitError'] = self._autoCalibration.fitError
+
+    if self._latencyTrace.settled(power):
+      self._dbusservice['/Trace/Histogram'] = self._latencyTrace.histogram()
+      self._dbusservice['/Trace/Completed'] = self._latencyTrace.completed
+
+    if self._dbusservice['/State'] >= 1 and self._role == 'acload':
+      deviation = abs(self._dbusservice['/Ac/PowerLimit'] - power)
+      if deviation > 50:
+        self._limitDeviationCounter = self._limitDeviationCounter + 1
+      else:
+        self._limitDeviationCounter = 0
 
 
   def _inverterControlPath(self, setting):
-    if self.settings['/DTU'] == 0:
+    if self._dtuLayout() == 0:
       # Ahoy
       ID = self.settings['/InverterID']
       path = '/'.join(self._inverterPath.split('/')[:-1])
@@ -703,7 +1389,7 @@ class HmInverter:
 
 
   def _inverterFormatLimit(self, limit):
-    if self.settings['/DTU'] == 0:
+    if self._dtuLayout() == 0:
       # Ahoy
       return '%sW' % limit
     else:
@@ -731,47 +1417,53 @@ class HmInverter:
       return None
   
 
-  def _getCalibrationValues(self, setPower):
-    try:
+  def _setCalibrationValues(self, array):
+    self._calibrationValues = array
+    if array is None:
+      self._calibrationCurve = None
+    else:
+      self._calibrationCurve = CalibrationCurve(array)
 
-      if self._calibrationValues is None:
-        return None,None
-      
-      if self._calibrationValues[0][1] > setPower:
-        return self._calibrationValues[0],self._calibrationValues[1]
-      
-      if self._calibrationValues[len(self._calibrationValues)-1][1] <= setPower:
-        return self._calibrationValues[len(self._calibrationValues)-2],self._calibrationValues[len(self._calibrationValues)-1]
 
-      for i in range(0,len(self._calibrationValues)-1):
-        if self._calibrationValues[i][1] <= setPower and self._calibrationValues[i+1][1] > setPower:
-          return self._calibrationValues[i],self._calibrationValues[i+1]
+  def _initAutoCalibration(self):
+    learned = self._getCalibrationArray(self.settings['/CalibrationLearned'])
+    self._autoCalibration = AutoCalibration(self.settings['/MaxPower'], None if learned is None else CalibrationCurve(learned))
 
-    except:
-      return None,None
-    
-    return None,None
+
+  def _saveAutoCalibration(self):
+    if self._autoCalibration is None or self._autoCalibration.changed == False:
+      return
+    # settings are stored in flash, write the learned curve at most every 5min
+    self._autoCalibration.changed = False
+    learned = self._autoCalibration.curve.toString()
+    self.settings['/CalibrationLearned'] = learned
+    self._dbusservice['/Ac/CalibrationLearned'] = learned
+    self._dbusservice['/Ac/MaxPower'] = self._getCalibratedMaxPower()
+    logging.log(EXTINFO,"Inverter %s learned calibration: %s" % (self._serial, learned))
 
 
   def _getCalibratedPower(self, setPower):
     if self._role == 'pvinverter':
       return setPower
-    
-    if self._dbusservice['/Ac/Calibration'] == 0:
-      return setPower
-    
-    calValLow, calValHi = self._getCalibrationValues(setPower)
-    if calValLow is None or calValHi is None:
-      return setPower
 
-    c = (calValHi[0]-calValLow[0])/(calValHi[1]-calValLow[1])
-    calPower = ((setPower-calValLow[1]) * c) + calValLow[0]
+    if self._dbusservice['/Ac/AutoCalibration'] == 1 and self._autoCalibration.curve is not None:
+      return self._autoCalibration.curve.setPower(setPower)
+
+    if self._dbusservice['/Ac/Calibration'] == 0 or self._calibrationCurve is None:
+      return setPower
 
-    return calPower
+    return self._calibrationCurve.setPower(setPower)
   
 
   def _getCalibratedMaxPower(self):
-    if self._role == 'pvinverter' or self.settings['/Calibration'] == 0 or self._calibrationValues is None:
+    if self._role == 'pvinverter':
+      return self.settings['/MaxPower']
+
+    if self.settings['/AutoCalibration'] == 1 and self._autoCalibration is not None and self._autoCalibration.curve is not None:
+      # expected output at the maximum limit
+      return max(int(self._autoCalibration.curve.measuredPower(self.settings['/MaxPower'])), 0)
+
+    if self.settings['/Calibration'] == 0 or self._calibrationValues is None:
       return self.settings['/MaxPower']
     
     if self._calibrationValues[len(self._calibrationValues)-1][0] == self.settings['/MaxPower']:
@@ -805,11 +1497,32 @@ class HmInverter:
     return (midnight - now).seconds
 
 
-  def _everySeconds(self,s):
-    if self._inverterLoopCounter % (s * INVERTERLOOPRATE) == 0:
-      return True
-    else:
-      return False
+################################################################################
+#                                                                              #
+#   Inverter Host                                                              #
+#                                                                              #
+################################################################################
+
+class InverterHost:
+
+  def __init__(self, serials):
+    self._dbus = dbusconnection()
+    self._dbusmonitor = inverterDbusMonitor()
+    self._inverters = {}
+
+    for serial in serials:
+      self._startInverter(serial)
+
+
+  def _startInverter(self, serial):
+    try:
+      self._inverters[serial] = HmInverter(serial, self._dbus, self._dbusmonitor)
+      logging.info("Inverter %s started" % (serial))
+    except Exception as e:
+      logging.exception('Error at %s', '_startInverter', exc_info=e)
+      logging.warning("Inverter %s failed to start, retry in 10s" % (serial))
+      gobject.timeout_add_seconds(10, self._startInverter, serial)
+    return False
 
 
 ################################################################################
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import time
+
+EXTINFO = 15
+
+LOGQUEUESIZE = 1000
+LOGRATE = 20          # records per second and process, errors are never dropped
+LOGBURST = 100
+
+
+################################################################################
+#                                                                              #
+#   Log writer                                                                 #
+#                                                                              #
+################################################################################
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+  # rotates at midnight and when the file exceeds maxBytes, backups are numbered
+
+  def __init__(self, filename, maxBytes, backupCount):
+    logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=maxBytes, backupCount=backupCount)
+    self._day = time.localtime().tm_yday
+
+
+  def shouldRollover(self, record):
+    day = time.localtime(record.created).tm_yday
+    if day != self._day:
+      self._day = day
+      return True
+    return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+
+
+class RateLimitedQueueHandler(logging.handlers.QueueHandler):
+  # never blocks the main loop, records over the rate or a full queue are counted and dropped
+
+  def __init__(self, queue, rate=LOGRATE, burst=LOGBURST):
+    logging.handlers.QueueHandler.__init__(self, queue)
+    self._rate = rate
+    self._burst = burst
+    self._tokens = burst
+    self._lastTime = time.monotonic()
+    self.dropped = 0
+
+
+  def emit(self, record):
+    now = time.monotonic()
+    self._tokens = min(self._burst, self._tokens + (now - self._lastTime) * self._rate)
+    self._lastTime = now
+    if record.levelno < logging.ERROR:
+      if self._tokens < 1:
+        self.dropped += 1
+        return
+      self._tokens -= 1
+
+    if self.dropped > 0:
+      dropped = self.dropped
+      self.dropped = 0
+      self._put(logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+        'msg': '%d log records dropped (pid %d)' % (dropped, os.getpid())}))
+    self._put(record)
+
+
+  def _put(self, record):
+    try:
+      self.enqueue(self.prepare(record))
+    except queue.Full:
+      self.dropped += 1
+    except Exception:
+      self.handleError(record)
+
+
+def startLogWriter(filename, level, maxBytes, backupCount, rate=LOGRATE, context=multiprocessing):
+  # call in the supervisor before the children are started, returns the listener
+  # context is the multiprocessing context the children are started with
+  global _logConfig
+  _logConfig = (context.Queue(LOGQUEUESIZE), level, rate)
+
+  formatter = logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S')
+  fileHandler = RotatingLogHandler(filename, maxBytes, backupCount)
+  fileHandler.setFormatter(formatter)
+  streamHandler = logging.StreamHandler()
+  streamHandler.setFormatter(formatter)
+  listener = logging.handlers.QueueListener(_logConfig[0], fileHandler, streamHandler)
+  listener.start()
+
+  initProcessLogging(_logConfig)
+  return listener
+
+
+def logConfig():
+  # pass to the child processes, they are not forked from the supervisor
+  return _logConfig
+
+
+def initProcessLogging(config):
+  # call at the start of every child process, replaces the inherited handlers
+  logQueue, level, rate = config
+  logging.addLevelName(EXTINFO, 'EXTINFO')
+  root = logging.getLogger()
+  for handler in list(root.handlers):
+    root.removeHandler(handler)
+  root.addHandler(RateLimitedQueueHandler(logQueue, rate))
+  root.setLevel(level)
+
+
+_logConfig = None
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# import normal packages
+import json
+import logging
+import os
+import sys
+import threading
+if sys.version_info.major == 2:
+    import gobject
+else:
+    from gi.repository import GLib as gobject
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# every process writes its metrics to METRICSDIR/<pid>.json if the directory exists,
+# the supervisor creates the directory and serves all processes on one endpoint
+METRICSDIR = '/tmp/dbus-hoymiles-metrics'
+METRICSINTERVAL = 10
+METRICSTIMEOUT = 10
+
+
+################################################################################
+#                                                                              #
+#   Metrics                                                                    #
+#                                                                              #
+################################################################################
+
+class Metrics:
+
+  def __init__(self):
+    self._families = {}
+
+
+  def clear(self):
+    self._families = {}
+
+
+  def add(self, name, type, help, value, **labels):
+    # type: counter, gauge or summary (value is (sum, count))
+    family = self._families.get(name)
+    if family is None:
+      family = self._families[name] = {'type': type, 'help': help, 'samples': []}
+    family['samples'].append([labels, value])
+
+
+  def merge(self, families, **labels):
+    for name, family in families.items():
+      for sampleLabels, value in family['samples']:
+        sampleLabels.update(labels)
+        self.add(name, family['type'], family['help'], value, **sampleLabels)
+
+
+  def families(self):
+    return self._families
+
+
+  def render(self):
+    lines = []
+    for name, family in sorted(self._families.items()):
+      lines.append('# TYPE %s %s' % (name, family['type']))
+      lines.append('# HELP %s %s' % (name, family['help']))
+      for labels, value in family['samples']:
+        if family['type'] == 'summary':
+          lines.append('%s_sum%s %s' % (name, _labels(labels), value[0]))
+          lines.append('%s_count%s %s' % (name, _labels(labels), value[1]))
+        elif family['type'] == 'counter':
+          lines.append('%s_total%s %s' % (name, _labels(labels), value))
+        else:
+          lines.append('%s%s %s' % (name, _labels(labels), value))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+def processRss(pid='self'):
+  try:
+    with open('/proc/%s/status' % (pid)) as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) * 1024
+  except Exception:
+    pass
+  return None
+
+
+def processAge():
+  # seconds since the process was forked
+  try:
+    with open('/proc/self/stat') as f:
+      start = int(f.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+    with open('/proc/uptime') as f:
+      return float(f.read().split()[0]) - start
+  except Exception:
+    return None
+
+
+################################################################################
+#                                                                              #
+#   Process metrics                                                            #
+#                                                                              #
+################################################################################
+
+class ProcessMetrics:
+
+  def __init__(self):
+    self._collectors = []
+    self._timer = None
+    self._startup = {}            # name -> (labels, seconds)
+
+
+  def register(self, collector):
+    # collector(metrics) adds the current values
+    self._collectors.append(collector)
+    if self._timer is None:
+      self._timer = gobject.timeout_add_seconds(METRICSINTERVAL, self._write)
+
+
+  def startupDone(self, name, **labels):
+    # time from fork until the process published the first measured value of name
+    if name in self._startup:
+      return
+    startup = processAge()
+    if startup is not None:
+      self._startup[name] = (labels, startup)
+      logging.info("Startup of %s took %.2f s until the first value" % (name, startup))
+
+
+  def _write(self):
+    if not os.path.isdir(METRICSDIR):
+      return True
+    metrics = Metrics()
+    for labels, startup in self._startup.values():
+      metrics.add('hoymiles_startup_seconds', 'gauge', 'Time from process start until the first measured value was published', round(startup, 3), **labels)
+    for collector in self._collectors:
+      try:
+        collector(metrics)
+      except Exception as e:
+        logging.exception('Error at %s', 'ProcessMetrics', exc_info=e)
+    filename = '%s/%d.json' % (METRICSDIR, os.getpid())
+    try:
+      with open(filename + '.tmp', 'w') as f:
+        json.dump(metrics.families(), f)
+      os.replace(filename + '.tmp', filename)
+    except Exception as e:
+      logging.exception('Error at %s', 'ProcessMetrics', exc_info=e)
+    return True
+
+
+_processMetrics = None
+
+def processMetrics():
+  global _processMetrics
+  if _processMetrics is None:
+    _processMetrics = ProcessMetrics()
+  return _processMetrics
+
+
+################################################################################
+#                                                                              #
+#   Metrics server                                                             #
+#                                                                              #
+################################################################################
+
+class MetricsServer:
+
+  def __init__(self, port, collect):
+    # collect() returns the rendered metrics of all processes
+    self._collect = collect
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      # a client that connects and sends nothing must not block the scrapes
+      timeout = METRICSTIMEOUT
+
+      def do_GET(self):
+        if self.path != '/metrics':
+          self.send_error(404)
+          return
+        try:
+          body = server._collect().encode()
+        except Exception as e:
+          logging.exception('Error at %s', 'MetricsServer', exc_info=e)
+          self.send_error(500)
+          return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    self._httpd.daemon_threads = True
+    threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+    logging.info("Metrics available at http://127.0.0.1:%d/metrics" % (port))
+
+
+def readProcessMetrics(pid):
+  try:
+    with open('%s/%d.json' % (METRICSDIR, pid)) as f:
+      return json.load(f)
+  except Exception:
+    return {}
@@ -12,6 +12,7 @@ else:
     from gi.repository import GLib as gobject
 import sys
 import configparser # for config/ini file
+import time
 import dbus
 
 from threading import Thread
@@ -22,6 +23,13 @@ from vedbus import VeDbusService
 from settingsdevice import SettingsDevice
 from dbusmonitor import DbusMonitor
 
+from Trace import formatTrace
+from Scheduler import Scheduler
+from RingBuffer import RingBuffer
+from Metrics import processMetrics
+from Subscriptions import DbusSubscriptions
+from Events import events, EV_SETLIMIT, EV_SETLIMIT_EXIT, EV_SETLIMIT_NOCHANGE, EV_SETLIMIT_NODEVICE, EV_SETPOWERLIMIT, EV_ACPOWERSETPOINT, EV_MAXFEEDINPOWER, EV_BASELOAD_LIMIT
+
 #formatting
 _kwh = lambda p, v: (str(round(v, 2)) + 'KWh')
 _a = lambda p, v: (str(round(v, 1)) + 'A')
@@ -34,6 +42,9 @@ _c = lambda p, v: (str(round(v, 1)) + '°C')
 EXTINFO = 15
 
 CONTROLLOOPRATE = 4
+LOADHISTORY = 600     # 1 s load samples, covers the maximum base load period of 10 minutes
+
+_ACTIVEINPATHS = [(f'/Ac/ActiveIn/L{i}/P', f'/Ac/ActiveIn/L{i}/I', f'/Ac/ActiveIn/L{i}/V') for i in range(1, 4)]
 
 class SystemBus(dbus.bus.BusConnection):
     def __new__(cls):
@@ -79,85 +90,192 @@ def new_service(base, type, physical, logical, id, instance):
 #                                                                              #
 ################################################################################
 
+# acload paths kept in the DbusInverter snapshot
+_DEVICEVALUES = {
+  '/Dc/Voltage':      'DcVoltage',
+  '/Dc/Current':      'DcCurrent',
+  '/Dc/Power':        'DcPower',
+  '/Ac/Efficiency':   'Efficiency',
+  '/Ac/Power':        'AcPower',
+  '/Temperature':     'Temperature',
+}
+_DEVICEPHASES = {}
+for _phase in range(0, 3):
+  _DEVICEPHASES[f'/Ac/L{_phase+1}/Power'] = ('AcPowerL', _phase)
+  _DEVICEPHASES[f'/Ac/L{_phase+1}/Current'] = ('AcCurrentL', _phase)
+  _DEVICEPHASES[f'/Ac/L{_phase+1}/Voltage'] = ('AcVoltageL', _phase)
+_DEVICEENABLED = {
+  '/Enabled':         '_enabled',
+  '/Ac/MaxPower':     '_maxPower',
+  '/Ac/MinPower':     '_minPower',
+  '/Ac/PowerLimit':   '_powerLimit',
+  '/Ac/PowerLimitAck': '_powerLimitAck',
+}
+_DEVICEPATHS = list(_DEVICEVALUES) + list(_DEVICEPHASES) + list(_DEVICEENABLED) + ['/DisableFeedIn', '/Connected', '/Ac/Energy/Forward']
+
+
 class DbusInverter:
+  # snapshot of the acload values, read once and then kept up to date by update()
+  # from the DbusMonitor value change callback, the control logic reads plain attributes
+  __slots__ = ('_service', '_dbusmonitor', '_energyOffset', '_instance', '_totals',
+               '_enabled', '_maxPower', '_minPower', '_powerLimit', '_powerLimitAck',
+               'MaxPower', 'MinPower', 'PowerLimit', 'PowerLimitAck', 'Active', 'Connected', 'Energy',
+               'DcVoltage', 'DcCurrent', 'DcPower', 'Efficiency', 'AcPower', 'Temperature',
+               'AcPowerL', 'AcCurrentL', 'AcVoltageL')
+
   def __init__(self,service,dbusmonitor):
     self._service = service
     self._dbusmonitor = dbusmonitor
     self._energyOffset = None
+    self._totals = None
+    self._instance = dbusmonitor.get_value(service,'/DeviceInstance') or 0
+    self.AcPowerL = [0] * 3
+    self.AcCurrentL = [0] * 3
+    self.AcVoltageL = [0] * 3
+    self._enabled = self._maxPower = self._minPower = self._powerLimit = self._powerLimitAck = None
+    for path in _DEVICEPATHS:
+      self.update(path, dbusmonitor.get_value(service, path))
+
+  def update(self, path, value):
+    attr = _DEVICEVALUES.get(path)
+    if attr is not None:
+      if self._totals is None:
+        setattr(self, attr, value or 0)
+      else:
+        old = getattr(self, attr)
+        setattr(self, attr, value or 0)
+        self._totals.changed(self, attr, old)
+      return
 
-  def _getMaxPower(self):
-    if self._dbusmonitor.get_value(self._service,'/Enabled') == 1:
-      return self._dbusmonitor.get_value(self._service,'/Ac/MaxPower') or 0
-    return 0
-  
-  def _getMinPower(self):
-    if self._dbusmonitor.get_value(self._service,'/Enabled') == 1:
-      return self._dbusmonitor.get_value(self._service,'/Ac/MinPower') or 0
-    return 0
+    phase = _DEVICEPHASES.get(path)
+    if phase is not None:
+      values = getattr(self, phase[0])
+      old = values[phase[1]]
+      values[phase[1]] = value or 0
+      if self._totals is not None:
+        self._totals.phaseChanged(self, phase[0], phase[1], old)
+      return
 
-  def _getPowerLimit(self):
-    if self._dbusmonitor.get_value(self._service,'/Enabled') == 1:
-      return self._dbusmonitor.get_value(self._service,'/Ac/PowerLimit') or 0
-    return 0
+    attr = _DEVICEENABLED.get(path)
+    if attr is not None:
+      setattr(self, attr, value)
+      self._updateEnabled()
+      return
 
-  def _getPowerLimitAck(self):
-    if self._dbusmonitor.get_value(self._service,'/Enabled') == 1:
-      return self._dbusmonitor.get_value(self._service,'/Ac/PowerLimitAck') or 1
-    return 1
-  
-  def _setPowerLimit(self,newLimit):
-    logging.log(EXTINFO,"_setPowerLimit(%s): %s" % (self._service, newLimit))
+    if path == '/DisableFeedIn':
+      self.Active = value == 0
+    elif path == '/Connected':
+      self.Connected = value == 1
+    elif path == '/Ac/Energy/Forward':
+      old = self.Energy if self._totals is not None else 0
+      energy = value or 0
+      if self._energyOffset is None:
+        if energy > 0:
+          self._energyOffset = energy
+        self.Energy = 0
+      else:
+        self.Energy = energy - self._energyOffset
+      if self._totals is not None:
+        self._totals.changed(self, 'Energy', old)
+
+  def _updateEnabled(self):
+    # the limits of a disabled inverter are ignored
+    enabled = self._enabled == 1
+    self.MaxPower = (self._maxPower or 0) if enabled else 0
+    self.MinPower = (self._minPower or 0) if enabled else 0
+    self.PowerLimit = (self._powerLimit or 0) if enabled else 0
+    self.PowerLimitAck = (self._powerLimitAck or 1) if enabled else 1
+
+  def sendPowerLimit(self,newLimit):
+    events.record(EV_SETPOWERLIMIT, self._instance, newLimit)
     self._dbusmonitor.set_value(self._service,'/Ac/PowerLimit',newLimit)
-  
-  def _getActive(self):
-    if self._dbusmonitor.get_value(self._service,'/DisableFeedIn') == 0:
-      return True
-    return False
 
-  def _setActive(self,active):
+  def setActive(self,active):
     if active == True:
       self._dbusmonitor.set_value(self._service,'/DisableFeedIn',0) 
     else:
       self._dbusmonitor.set_value(self._service,'/DisableFeedIn',1)
 
-  def _getEnergy(self):
-    energy = self._dbusmonitor.get_value(self._service,'/Ac/Energy/Forward') or 0
-    if self._energyOffset is None:
-      if energy > 0:
-        self._energyOffset = energy
-      return 0
-    else:
-      return energy - self._energyOffset
-
-  MaxPower = property(fget=_getMaxPower)
-  MinPower = property(fget=_getMinPower)
-  PowerLimit = property(fget=_getPowerLimit, fset=_setPowerLimit)
-  PowerLimitAck = property(fget=_getPowerLimitAck)
-  Active = property(fget=_getActive, fset=_setActive)
-  Energy = property(fget=_getEnergy)
-  DcVoltage = property(fget=lambda self: self._dbusmonitor.get_value(self._service,'/Dc/Voltage') or 0)
-  DcCurrent = property(fget=lambda self: self._dbusmonitor.get_value(self._service,'/Dc/Current') or 0)
-  DcPower = property(fget=lambda self: self._dbusmonitor.get_value(self._service,'/Dc/Power') or 0)
-  Efficiency = property(fget=lambda self: self._dbusmonitor.get_value(self._service,'/Ac/Efficiency') or 0)
-  AcPower = property(fget=lambda self: self._dbusmonitor.get_value(self._service,'/Ac/Power') or 0)
-  Temperature = property(fget=lambda self: self._dbusmonitor.get_value(self._service,'/Temperature') or 0)
-
-  def AcPowerL(self,phase):
-    return self._dbusmonitor.get_value(self._service,f'/Ac/L{phase}/Power') or 0
-  
-  def AcCurrentL(self,phase):
-    return self._dbusmonitor.get_value(self._service,f'/Ac/L{phase}/Current') or 0
-  
-  def AcVoltageL(self,phase):
-    return self._dbusmonitor.get_value(self._service,f'/Ac/L{phase}/Voltage') or 0
-
-  def setPowerLimit(self,newLimit):
+  def setPowerLimit(self,newLimit,trace=None):
     newLimit = int(min(newLimit, self.MaxPower))
     newLimit = int(max(newLimit, self.MinPower))
-    self.PowerLimit = newLimit
+    if trace is not None:
+      self._dbusmonitor.set_value(self._service,'/Ac/PowerLimitTrace',trace)
+    self.sendPowerLimit(newLimit)
     return newLimit
 
 
+def _dcPower(acPower, efficiency):
+  return acPower / efficiency if efficiency > 0 else 0
+
+
+class InverterTotals:
+  # running sums over all inverters, DbusInverter.update() applies the difference of
+  # every changed value so that publishing the totals does not depend on the inverter count
+  __slots__ = ('_devices', 'DcPower', 'DcCurrent', 'AcPowerL', 'AcCurrentL', 'AcVoltageL',
+               'Energy', 'AcPower', 'EfficiencyDc', 'Temperature')
+
+  def __init__(self):
+    self._devices = []
+    self.resync()
+
+  def add(self, device):
+    self._devices.append(device)
+    device._totals = self
+    self.resync()
+
+  def remove(self, device):
+    self._devices.remove(device)
+    device._totals = None
+    self.resync()
+
+  def resync(self):
+    # exact sums, also removes the rounding error of the running sums
+    self.DcPower = sum(device.DcPower for device in self._devices)
+    self.DcCurrent = sum(device.DcCurrent for device in self._devices)
+    self.AcPowerL = [sum(device.AcPowerL[i] for device in self._devices) for i in range(0,3)]
+    self.AcCurrentL = [sum(device.AcCurrentL[i] for device in self._devices) for i in range(0,3)]
+    self.AcVoltageL = [max([device.AcVoltageL[i] for device in self._devices] + [0]) for i in range(0,3)]
+    self.Energy = sum(device.Energy for device in self._devices)
+    self.AcPower = sum(device.AcPower for device in self._devices)
+    self.EfficiencyDc = sum(_dcPower(device.AcPower, device.Efficiency) for device in self._devices)
+    self.Temperature = max([device.Temperature for device in self._devices] + [0])
+
+  def changed(self, device, attr, old):
+    if attr == 'DcPower':
+      self.DcPower += device.DcPower - old
+    elif attr == 'DcCurrent':
+      self.DcCurrent += device.DcCurrent - old
+    elif attr == 'Energy':
+      self.Energy += device.Energy - old
+    elif attr == 'AcPower':
+      self.AcPower += device.AcPower - old
+      self.EfficiencyDc += _dcPower(device.AcPower, device.Efficiency) - _dcPower(old, device.Efficiency)
+    elif attr == 'Efficiency':
+      self.EfficiencyDc += _dcPower(device.AcPower, device.Efficiency) - _dcPower(device.AcPower, old)
+    elif attr == 'Temperature':
+      if device.Temperature >= self.Temperature:
+        self.Temperature = device.Temperature
+      elif old == self.Temperature:
+        self.Temperature = max([d.Temperature for d in self._devices] + [0])
+
+  def phaseChanged(self, device, attr, phase, old):
+    if attr == 'AcPowerL':
+      self.AcPowerL[phase] += device.AcPowerL[phase] - old
+    elif attr == 'AcCurrentL':
+      self.AcCurrentL[phase] += device.AcCurrentL[phase] - old
+    elif device.AcVoltageL[phase] >= self.AcVoltageL[phase]:
+      self.AcVoltageL[phase] = device.AcVoltageL[phase]
+    elif old == self.AcVoltageL[phase]:
+      self.AcVoltageL[phase] = max([d.AcVoltageL[phase] for d in self._devices] + [0])
+
+  def efficiency(self):
+    # in %, 0 without AC power
+    if abs(self.EfficiencyDc) < 0.001:
+      return 0
+    return self.AcPower / self.EfficiencyDc
+
+
 ################################################################################
 #                                                                              #
 #   Inverter Control                                                           #
@@ -167,18 +285,21 @@ class DbusInverter:
 class MicroPlus:
   def __init__(self):
     self.settings = None
-    self._controlLoopCounter = 0
-    self._pvPowerHistory =  [0] * 60
-    self._pvPowerAvg =  [0] * 20
+    self._pvPowerHistory = RingBuffer(60)
+    self._pvPowerAvg = RingBuffer(20)
     self._gridPower = 0
     self._loadPower = 0
     self._gridPowerFilter = 0
-    self._loadPowerHistory =  [600] * 15 
-    self._loadPowerMin = [600] * 40
-    self._powerLimitCounter = 10
+    self._loadPowerHistory = RingBuffer(LOADHISTORY, 600, minmax=True)
+    self._limitTime = time.monotonic() - 2.5
     self._limitChangeCounter = 0
-    self._limitChangeHistory =  [0] * 60
+    self._limitChangeTotal = 0
+    self._controlLoopTime = 0
+    self._controlLoopCount = 0
+    self._controlLoopMax = 0
+    self._limitChangeHistory = RingBuffer(60)
     self._dbus = dbusconnection()
+    self._powerMeter = None
     self._powerMeterService = None
     self._gridService = None
     self._excessPower = 0
@@ -187,12 +308,23 @@ class MicroPlus:
     self._devinst = 50
     self._dbusservice = None
     self._inverterDcShutdown = False
-    self._inverterDcShutdownCounter = 0
-
-    self._devices = []
-
+    self._inverterDcTime = 0
+    self._gridSampleTime = 0
+    self._traceId = 0
+
+    self._acloads = {}            # service -> (name, instance, inverter)
+    self._devices = []            # inverters sorted by MaxPower
+    self._deviceByService = {}    # inverters and power meter
+    self._totals = InverterTotals()
+    self._subscribedDevices = None
+    self._signalCount = 0
+    self._signalTime = 0
+    self._signalSampleTime = time.monotonic()
+
+    processMetrics().register(self._collectMetrics)
     self._initDbusMonitor()
     self._gridService = self._dbusmonitor.get_value('com.victronenergy.system','/Ac/In/0/ServiceName')
+    self._initDispatch()
     
     self._initDeviceSettings()
 
@@ -200,8 +332,16 @@ class MicroPlus:
 
     self._checkState()
 
-    # add _controlLoop function 'timer'
-    gobject.timeout_add(1000 / CONTROLLOOPRATE, self._controlLoop)
+    # add control loop tasks
+    self._scheduler = Scheduler(self.settings['/ControlLoopRate'])
+    self._scheduler.every(None, self._controlLoop)
+    self._scheduler.every(1, self._sampleLoop)
+    self._scheduler.every(5, self._statusLoop)
+    self._scheduler.every(15, self._baseLoadLoop)
+    self._scheduler.every(30, self._maxPowerLoop)
+    self._scheduler.every(60, self._minuteLoop)
+    self._scheduler.every(300, self._checkState)
+    self._scheduler.start()
 
 
   def _initDbusservice(self):
@@ -221,6 +361,10 @@ class MicroPlus:
       '/Debug/LimitChange1min':             {'initial': 0, 'textformat': None},
       '/Debug/LimitChange10min':            {'initial': 0, 'textformat': None},
       '/Debug/LimitChange60min':            {'initial': 0, 'textformat': None},
+      '/Debug/SchedulerMisses':             {'initial': 0, 'textformat': None},
+      '/Debug/EventDump':                   {'initial': 0, 'textformat': None},
+      '/Debug/SignalRate':                  {'initial': 0, 'textformat': None},
+      '/Debug/SignalHandlerTime':           {'initial': 0, 'textformat': None},
 
       '/Ac/ActiveIn/L1/V':                  {'initial': 0, 'textformat': _v},
       '/Ac/ActiveIn/L2/V':                  {'initial': 0, 'textformat': _v},
@@ -363,12 +507,12 @@ class MicroPlus:
   def _handleChangedValue(self, path, value):
     #logging.log(EXTINFO,"dbus_value_changed: %s %s" % (path, value,))
   
-    if path == '/Hub4/L1/AcPowerSetpoint' and self._powerLimitCounter >= self.settings['/InverterMinimumInterval'] * CONTROLLOOPRATE and self.settings['/LimitMode'] == 3:
-      logging.log(EXTINFO,"AcPowerSetpoint: %s" % (value * 3))
+    if path == '/Hub4/L1/AcPowerSetpoint' and self._limitAge() >= self.settings['/InverterMinimumInterval'] and self.settings['/LimitMode'] == 3:
+      events.record(EV_ACPOWERSETPOINT, value * 3)
       self._dbusservice['/Ac/PowerLimit'] = self._setLimit(-value * 3, self._dbusservice['/Hub4/L1/MaxFeedInPower'] * 3)
 
-    if path == '/Hub4/L1/MaxFeedInPower' and self._powerLimitCounter >= self.settings['/InverterMinimumInterval'] * CONTROLLOOPRATE * 1.5 and self.settings['/LimitMode'] == 3:
-      logging.log(EXTINFO,"MaxFeedInPower: %s" % (value * 3))
+    if path == '/Hub4/L1/MaxFeedInPower' and self._limitAge() >= self.settings['/InverterMinimumInterval'] * 1.5 and self.settings['/LimitMode'] == 3:
+      events.record(EV_MAXFEEDINPOWER, value * 3)
       self._dbusservice['/Ac/PowerLimit'] = self._setLimit(-self._dbusservice['/Hub4/L1/AcPowerSetpoint'] * 3, value * 3)
     
     if path == '/Hub4/DisableFeedIn':
@@ -381,6 +525,11 @@ class MicroPlus:
       self._dbusservice['/Mode'] = value
       self._checkState()
 
+    if path == '/Debug/EventDump':
+      if value != 0:
+        events.dump("%s/events_microplus.bin" % (os.path.dirname(os.path.realpath(__file__))))
+      return False
+
     if path == '/Ac/PowerLimit':
       logging.log(EXTINFO,"dbus_value_changed: %s %s" % (path, value,))
       if self.settings['/LimitMode'] == 4:
@@ -398,60 +547,112 @@ class MicroPlus:
 
   def _controlLoop(self):
     if self._dbusservice is None:
-        return True
+        return
     
+    start = time.perf_counter()
     try:
-      self._controlLoopCounter +=1
-      self._powerLimitCounter +=1
-      
       self._updateVebusTotal()
       self._getSystemPower()
       self._calcLimit()
 
-      # 5s interval
-      if self._everySeconds(5):
-        self._infoTopic()
-        self._calcFeedInExcess()
-
-      # 5min interval
-      if self._everySeconds(300):
-        self._controlLoopCounter = 0
-        self._checkState()
-      
-      if self._excessPower > 0 and self.settings['/LimitMode'] == 3 and self._powerLimitCounter >= self.settings['/InverterMinimumInterval'] * CONTROLLOOPRATE:
+      if self._excessPower > 0 and self.settings['/LimitMode'] == 3 and self._limitAge() >= self.settings['/InverterMinimumInterval']:
         self._dbusservice['/Ac/PowerLimit'] = self._setLimit(-self._dbusservice['/Hub4/L1/AcPowerSetpoint'] * 3, self._dbusservice['/Hub4/L1/MaxFeedInPower'] * 3)
 
-      if self._inverterDcShutdown == True:
+      # the DC voltage has to stay above/below the threshold for 10s
+      now = time.monotonic()
+      if self._dbusservice['/Dc/0/Voltage'] is None:
+        # no inverter with valid data
+        self._inverterDcTime = now
+      elif self._inverterDcShutdown == True:
         if self._dbusservice['/Dc/0/Voltage'] >= self.settings['/InverterDcRestartVoltage']:
-          if self._inverterDcShutdownCounter  >= 10 * CONTROLLOOPRATE :
+          if now - self._inverterDcTime >= 10:
             self._inverterDcShutdown = False
+            self._inverterDcTime = now
             self._checkState()
-          else:
-            self._inverterDcShutdownCounter  += 1
         else:
-          self._inverterDcShutdownCounter  = 0
+          self._inverterDcTime = now
       else:
         if self._dbusservice['/Dc/0/Voltage'] <= self.settings['/InverterDcShutdownVoltage']:
-          if self._inverterDcShutdownCounter  <= 0:
+          if now - self._inverterDcTime >= 10:
             self._inverterDcShutdown = True
+            self._inverterDcTime = now
             self._checkState()
-          else:
-            self._inverterDcShutdownCounter  -= 1
         else:
-          self._inverterDcShutdownCounter = 10 * CONTROLLOOPRATE
+          self._inverterDcTime = now
 
-      self._debugOut(2, "%.*f" %(2,self._powerLimitCounter / CONTROLLOOPRATE))
+      self._debugOut(2, "%.*f" %(2,self._limitAge()))
       self._debugOut(3, "%.*f" %(0,self._limitChangeCounter))
 
     except Exception as e:
       logging.exception('Error at %s', '_inverterLoop', exc_info=e)
 
-    return True
+    duration = time.perf_counter() - start
+    self._controlLoopTime += duration
+    self._controlLoopCount += 1
+    self._controlLoopMax = max(self._controlLoopMax, duration)
+
+
+  def _statusLoop(self):
+    if self._dbusservice is None:
+        return
+    self._updateVebusStatistics()
+    self._infoTopic()
+    self._calcFeedInExcess()
+    self._updateSignalStatistics()
+
+
+  def _updateSignalStatistics(self):
+    now = time.monotonic()
+    signals = self._subscriptions.signals - self._signalCount
+    handlerTime = self._subscriptions.handlerTime - self._signalTime
+    self._dbusservice['/Debug/SignalRate'] = round(signals / max(now - self._signalSampleTime, 0.001), 1)
+    self._dbusservice['/Debug/SignalHandlerTime'] = round(handlerTime / signals * 1000000) if signals else 0
+    self._signalCount = self._subscriptions.signals
+    self._signalTime = self._subscriptions.handlerTime
+    self._signalSampleTime = now
+
+
+  def _minuteLoop(self):
+    if self._dbusservice is None:
+        return
+    self._pvPowerAvg.append(int(self._pvPowerHistory.mean()))
+    self._dbusservice['/PvAvgPower'] = int(self._pvPowerAvg.mean())
+    self._dbusservice['/Debug/SchedulerMisses'] = self._scheduler.taskMisses()
+    self._totals.resync()
+
+    if self._dbusservice['/State'] != 0:
+      self._checkStartLimit()
+      self._limitChangeHistory.append(self._limitChangeCounter)
+      self._dbusservice['/Debug/LimitChange1min'] = self._limitChangeCounter
+      self._dbusservice['/Debug/LimitChange10min'] = int(self._limitChangeHistory.sum(10))
+      self._dbusservice['/Debug/LimitChange60min'] = int(self._limitChangeHistory.sum())
+      self._limitChangeCounter = 0
+
+
+  def _collectMetrics(self, metrics):
+    if self._dbusservice is None:
+      return
+    metrics.add('hoymiles_limit_changes', 'counter', 'Limit changes of MicroPlus', self._limitChangeTotal)
+    metrics.add('hoymiles_limit_changes_10min', 'gauge', 'Limit changes in the last 10 minutes', int(self._limitChangeHistory.sum(10)))
+    metrics.add('hoymiles_limit_changes_60min', 'gauge', 'Limit changes in the last 60 minutes', int(self._limitChangeHistory.sum()))
+    metrics.add('hoymiles_control_loop_seconds', 'summary', 'Duration of the control loop', (self._controlLoopTime, self._controlLoopCount))
+    metrics.add('hoymiles_control_loop_max_seconds', 'gauge', 'Longest control loop since the last collection', self._controlLoopMax)
+    metrics.add('hoymiles_scheduler_misses', 'counter', 'Late control loop ticks and tasks', self._scheduler.taskMisses())
+    metrics.add('hoymiles_power_limit_watts', 'gauge', 'Total power limit', self._dbusservice['/Ac/PowerLimit'])
+    metrics.add('hoymiles_grid_power_watts', 'gauge', 'Grid power', self._gridPower)
+    if self._subscriptions.enabled:
+      metrics.add('hoymiles_dbus_signals', 'counter', 'D-Bus signals received by MicroPlus', self._subscriptions.signals)
+      metrics.add('hoymiles_dbus_signal_handler_seconds', 'summary', 'Duration of the D-Bus signal handlers', (self._subscriptions.handlerTime, self._subscriptions.signals))
+    self._controlLoopMax = 0
+
+
+  def _limitAge(self):
+    return time.monotonic() - self._limitTime
 
 
   def _initDbusMonitor(self):
     dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
-    dbus_tree = {
+    self._dbusTree = dbus_tree = {
       'com.victronenergy.settings': { # Not our settings
         '/Settings/CGwacs/BatteryLife/State': dummy,
         '/Settings/CGwacs/OvervoltageFeedIn': dummy,
@@ -483,6 +684,7 @@ class MicroPlus:
       'com.victronenergy.acload': {
         '/Ac/Power': dummy,
         '/Ac/PowerLimit': dummy,
+        '/Ac/PowerLimitTrace': dummy,
         '/Ac/MaxPower': dummy,
         '/Ac/MinPower': dummy,
         '/Ac/Efficiency': dummy,
@@ -517,53 +719,106 @@ class MicroPlus:
       },
     }
     self._dbusmonitor = DbusMonitor(dbus_tree, valueChangedCallback=self._dbusValueChanged, deviceAddedCallback= self._dbusDeviceAdded, deviceRemovedCallback=self._dbusDeviceRemoved)
+    # solarchargers and unused acloads are only needed for these paths
+    self._subscriptions = DbusSubscriptions(self._dbusmonitor, ['/MppOperationMode', '/Connected'])
+
+
+  def _updateSubscriptions(self):
+    services = {
+      'com.victronenergy.settings': list(self._dbusTree['com.victronenergy.settings']),
+      'com.victronenergy.system': list(self._dbusTree['com.victronenergy.system']),
+      'com.victronenergy.hub4': None,
+    }
+    self._subscribedDevices = set(self._deviceByService)
+    for service in self._deviceByService:
+      services[service] = None
+    if self._gridService is not None and self._gridService not in services:
+      services[self._gridService] = ['/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power']
+    self._subscriptions.subscribe(services)
+
+
+  def _initDispatch(self):
+    self._dispatch = {
+      ('com.victronenergy.settings', '/Settings/CGwacs/BatteryLife/State'): (self._logValue, self._stateValueChanged),
+      ('com.victronenergy.settings', '/Settings/CGwacs/OvervoltageFeedIn'): (self._overvoltageFeedInChanged,),
+      ('com.victronenergy.system', '/Dc/Battery/Soc'): (self._logValue, self._stateValueChanged),
+      ('com.victronenergy.system', '/Ac/In/0/ServiceName'): (self._gridServiceChanged,),
+      ('com.victronenergy.hub4', '/PvPowerLimiterActive'): (self._logValue,),
+      ('com.victronenergy.hub4', '/MaxDischargePower'): (self._maxDischargePowerChanged,),
+    }
 
 
   def _dbusValueChanged(self,dbusServiceName, dbusPath, options, changes, deviceInstance):
-    if dbusPath in {'/Dc/Battery/Soc','/Settings/CGwacs/BatteryLife/State','/Hub','/PvPowerLimiterActive'}:
-      logging.log(EXTINFO,"dbus_value_changed: %s %s %s" % (dbusServiceName, dbusPath, changes['Value']))
+    device = self._deviceByService.get(dbusServiceName)
+    if device is not None:
+      device.update(dbusPath, changes['Value'])
 
-    if dbusPath in {'/Settings/CGwacs/BatteryLife/State','/Dc/Battery/Soc'}:
-      self._checkState()
+    handlers = self._dispatch.get((dbusServiceName, dbusPath))
+    if handlers is not None:
+      for handler in handlers:
+        handler(dbusServiceName, dbusPath, changes['Value'])
 
-    elif dbusPath == '/Connected':
-      self._refreshAcloads()
 
-    elif dbusPath == '/Settings/CGwacs/OvervoltageFeedIn':
-      if changes['Value'] == 0:
-        self._excessPower = 0
+  def _logValue(self, service, path, value):
+    logging.log(EXTINFO,"dbus_value_changed: %s %s %s" % (service, path, value))
+
+
+  def _stateValueChanged(self, service, path, value):
+    self._checkState()
+
+
+  def _connectedChanged(self, service, path, value):
+    if service in self._acloads:
+      self._updateAcload(service)
+      self._acloadsChanged()
 
-    elif self._dbusservice is None:
+
+  def _overvoltageFeedInChanged(self, service, path, value):
+    if value == 0:
+      self._excessPower = 0
+
+
+  def _enabledChanged(self, service, path, value):
+    self._sortDevices()
+    if self._dbusservice is None:
       return
-    
-    elif dbusPath == '/Enabled':
-      self._dbusservice['/Ac/MaxPower'] = self._availablePower()
-      self._devices.sort(reverse=True, key=lambda x: x.MaxPower)
-      self._checkState()
+    self._dbusservice['/Ac/MaxPower'] = self._availablePower()
+    self._checkState()
 
-    elif dbusPath == '/Ac/MaxPower':
-      self._dbusservice['/Ac/MaxPower'] = self._availablePower()
 
-    elif dbusPath == '/MaxDischargePower':
-      if (self._actualLimit() > changes['Value']) and (self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/Hub4Mode') != 3):
-        self._dbusservice['/Ac/PowerLimit'] = self._setLimit(changes['Value'], self._maxFeedInPower())
+  def _maxPowerChanged(self, service, path, value):
+    self._sortDevices()
+    if self._dbusservice is None:
+      return
+    self._dbusservice['/Ac/MaxPower'] = self._availablePower()
 
-    elif dbusPath == '/Ac/In/0/ServiceName':
-      self._gridService = changes['Value']
-      logging.info("dbus_value_changed: %s %s %s" % (dbusServiceName, dbusPath, changes['Value']))
 
-    return
+  def _maxDischargePowerChanged(self, service, path, value):
+    if self._dbusservice is None:
+      return
+    if (self._actualLimit() > value) and (self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/Hub4Mode') != 3):
+      self._dbusservice['/Ac/PowerLimit'] = self._setLimit(value, self._maxFeedInPower())
+
+
+  def _gridServiceChanged(self, service, path, value):
+    self._gridService = value
+    logging.info("dbus_value_changed: %s %s %s" % (service, path, value))
+    self._updateSubscriptions()
 
 
   def _dbusDeviceAdded(self,dbusservicename, instance):
     logging.info("dbus device added: %s %s " % (dbusservicename, instance))
-    self._refreshAcloads()
+    if dbusservicename.startswith('com.victronenergy.acload.') and dbusservicename not in self._acloads:
+      self._addAcload(dbusservicename)
+      self._acloadsChanged()
     return
 
 
   def _dbusDeviceRemoved(self,dbusservicename, instance):
     logging.info("dbus device removed: %s %s " % (dbusservicename, instance))
-    self._refreshAcloads()
+    if dbusservicename in self._acloads:
+      self._removeAcload(dbusservicename)
+      self._acloadsChanged()
     return
 
 
@@ -599,6 +854,8 @@ class MicroPlus:
         '/GridFilterWeight':              [path + '/GridFilterWeight', 20, 1, 100],
         '/GridFilterWeightMax':           [path + '/GridFilterWeightMax', 90, 1, 100],
         '/DebugOutput':                   [path + '/DebugOutput', 0, 0, 1],
+        '/LatencyTrace':                  [path + '/LatencyTrace', 0, 0, 1],
+        '/ControlLoopRate':               [path + '/ControlLoopRate', CONTROLLOOPRATE, 1, 10],
         
     }
 
@@ -610,7 +867,7 @@ class MicroPlus:
     logging.info("setting changed, setting: %s, old: %s, new: %s" % (setting, oldvalue, newvalue))
 
     if setting == '/PowerMeterInstance':
-      self._refreshAcloads()
+      self._acloadsChanged()
 
     elif setting == '/StartLimit' or setting == '/StartLimitMax':
       self._checkStartLimit()
@@ -623,6 +880,9 @@ class MicroPlus:
       if self.settings['/InverterDcRestartVoltage'] <= newvalue:
         self.settings['/InverterDcRestartVoltage'] = newvalue + 0.1
 
+    elif setting == '/ControlLoopRate':
+      self._scheduler.setRate(newvalue)
+
     elif setting == '/DebugOutput' and newvalue == 0:
       for i in range(0,4):
         self._dbusservice[f'/Debug/Debug{i}'] = None
@@ -634,63 +894,48 @@ class MicroPlus:
 
 
   def _updateVebusTotal(self):
-    inverterTotalPower = [0] * 3
-    inverterTotalCurrent = [0] * 3
-    inverterAcVoltage = [0] * 3
-    inverterTotalPowerDC = 0
-    inverterTotalCurrentDC = 0
-    inverterTotalEnergy = 0
-    voltageDC = 0
-    efficiency = 0
-    efficiencyP = 0
-    temperature = 0
-
-    if len(self._devices) == 0:
-      voltageDC = 0
-    else:
-      voltageDC = self._devices[0].DcVoltage
-
-    if self._powerMeterService is not None:
-      self._dbusservice['/Ac/Power'] =  self._dbusmonitor.get_value(self._powerMeterService,'/Ac/Power') or 0
-      for i in range(0,3):
-        inverterTotalPower[i] = self._dbusmonitor.get_value(self._powerMeterService,f'/Ac/L{i+1}/Power') or 0
-        inverterTotalCurrent[i] = self._dbusmonitor.get_value(self._powerMeterService,f'/Ac/L{i+1}/Current') or 0
-        inverterAcVoltage[i] = max(inverterAcVoltage[i],self._dbusmonitor.get_value(self._powerMeterService,f'/Ac/L{i+1}/Voltage') or 0)
-      inverterTotalPowerDC = self._dbusservice['/Ac/Power'] / self._efficiency()
-      inverterTotalCurrentDC = 0 if voltageDC == 0 else (inverterTotalPowerDC / voltageDC) * -1
+    # publishes the totals maintained by InverterTotals or the power meter snapshot
+    voltageDC = None
+    for device in self._devices:
+      if device.Connected:
+        voltageDC = device.DcVoltage
+        break
+
+    if self._powerMeter is not None:
+      acPower = self._powerMeter.AcPower
+      inverterTotalPower = self._powerMeter.AcPowerL
+      inverterTotalCurrent = self._powerMeter.AcCurrentL
+      inverterAcVoltage = self._powerMeter.AcVoltageL
+      inverterTotalPowerDC = acPower / self._efficiency()
+      inverterTotalCurrentDC = 0 if not voltageDC else (inverterTotalPowerDC / voltageDC) * -1
 
     else:
-      for device in self._devices:
-        inverterTotalPowerDC += device.DcPower
-        inverterTotalCurrentDC += device.DcCurrent
-        for i in range(0,3):
-          inverterTotalPower[i] += device.AcPowerL(i+1)
-          inverterTotalCurrent[i] += device.AcCurrentL(i+1)
-          inverterAcVoltage[i] = max(inverterAcVoltage[i],device.AcVoltageL(i+1))
-      self._dbusservice['/Ac/Power'] = sum(inverterTotalPower)
-
+      inverterTotalPower = self._totals.AcPowerL
+      inverterTotalCurrent = self._totals.AcCurrentL
+      inverterAcVoltage = self._totals.AcVoltageL
+      inverterTotalPowerDC = self._totals.DcPower
+      inverterTotalCurrentDC = self._totals.DcCurrent
+      acPower = inverterTotalPower[0] + inverterTotalPower[1] + inverterTotalPower[2]
+
+    self._dbusservice['/Ac/Power'] = acPower
     for i in range(0,3):
-      self._dbusservice[f'/Ac/ActiveIn/L{i+1}/P'] = 0 - inverterTotalPower[i]
-      self._dbusservice[f'/Ac/ActiveIn/L{i+1}/I'] = 0 - inverterTotalCurrent[i]
-      self._dbusservice[f'/Ac/ActiveIn/L{i+1}/V'] = inverterAcVoltage[i]
-    self._dbusservice['/Ac/ActiveIn/P'] = 0 - self._dbusservice['/Ac/Power']
+      pathP, pathI, pathV = _ACTIVEINPATHS[i]
+      self._dbusservice[pathP] = 0 - inverterTotalPower[i]
+      self._dbusservice[pathI] = 0 - inverterTotalCurrent[i]
+      self._dbusservice[pathV] = inverterAcVoltage[i]
+    self._dbusservice['/Ac/ActiveIn/P'] = 0 - acPower
     self._dbusservice['/Dc/0/Power'] = 0 - inverterTotalPowerDC
     self._dbusservice['/Dc/0/Current'] = inverterTotalCurrentDC
     self._dbusservice['/Dc/0/Voltage'] = voltageDC
+    if voltageDC is not None:
+      # totals of at least one connected inverter
+      processMetrics().startupDone('microplus')
 
-    # 5s interval
-    if self._everySeconds(5):
-      for device in self._devices:
-        inverterTotalEnergy += device.Energy
-        eff = device.Efficiency
-        effP = device.AcPower
-        if eff > 0:
-          efficiency += effP / eff
-        efficiencyP += effP
-        temperature = max(temperature, device.Temperature)
-      self._dbusservice['/Temperature'] = temperature
-      self._dbusservice['/Ac/Efficiency'] = 0 if efficiency == 0 else efficiencyP / efficiency
-      self._dbusservice['/Energy/InverterToAcIn1'] = inverterTotalEnergy
+
+  def _updateVebusStatistics(self):
+    self._dbusservice['/Temperature'] = self._totals.Temperature
+    self._dbusservice['/Ac/Efficiency'] = self._totals.efficiency()
+    self._dbusservice['/Energy/InverterToAcIn1'] = self._totals.Energy
 
 
   def _getSystemPower(self):
@@ -703,30 +948,20 @@ class MicroPlus:
        L2 = (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Grid/L2/Power') or 0)
        L3 = (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Grid/L3/Power') or 0)
     self._gridPower = L1 + L2 + L3
+    self._gridSampleTime = time.monotonic()
     self._gridPowerFilter = self._gridFilter()
     
     self._debugOut(1, round(self._gridPowerFilter,0))
 
-    #1s interval
-    if self._everySeconds(1):
-      self._loadPower = (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L1/Power') or 0) + \
-                      (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L2/Power') or 0) + \
-                      (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L3/Power') or 0)
-      self._loadPowerHistory.pop(len(self._loadPowerHistory)-1)
-      self._loadPowerHistory.insert(0,self._loadPower)
-      self._pvPowerHistory.pop(len(self._pvPowerHistory)-1)
-      self._pvPowerHistory.insert(0,self._dbusmonitor.get_value('com.victronenergy.system','/Dc/Pv/Power') or 0)
-
-    # 15s interval
-    if self._everySeconds(15):
-      self._loadPowerMin.pop(len(self._loadPowerMin)-1)
-      self._loadPowerMin.insert(0,min(self._loadPowerHistory))
 
-    # 60s interval
-    if self._everySeconds(60):
-      self._pvPowerAvg.pop(len(self._pvPowerAvg)-1)
-      self._pvPowerAvg.insert(0,int(sum(self._pvPowerHistory) / len(self._pvPowerHistory)))
-      self._dbusservice['/PvAvgPower'] = int(sum(self._pvPowerAvg) / len(self._pvPowerAvg))
+  def _sampleLoop(self):
+    if self._dbusservice is None:
+        return
+    self._loadPower = (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L1/Power') or 0) + \
+                    (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L2/Power') or 0) + \
+                    (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L3/Power') or 0)
+    self._loadPowerHistory.append(self._loadPower)
+    self._pvPowerHistory.append(self._dbusmonitor.get_value('com.victronenergy.system','/Dc/Pv/Power') or 0)
 
 
   def _gridFilter(self):
@@ -761,36 +996,17 @@ class MicroPlus:
 
       newTarget = 0
 
-      # 1min interval
-      if self._everySeconds(60):
-        self._checkStartLimit()
-        self._limitChangeHistory.pop(len(self._limitChangeHistory)-1)
-        self._limitChangeHistory.insert(0,self._limitChangeCounter)
-        self._dbusservice['/Debug/LimitChange1min'] = self._limitChangeCounter
-        self._dbusservice['/Debug/LimitChange10min'] = sum(self._limitChangeHistory[0:10])
-        self._dbusservice['/Debug/LimitChange60min'] = sum(self._limitChangeHistory)
-        self._limitChangeCounter = 0
-
-      # Maximum power
-      if self.settings['/LimitMode'] == 0:
-        # 30s interval
-        if self._everySeconds(30):
-          newTarget = 0 
-          for device in self._devices:
-            newTarget += device.MaxPower
-          self._dbusservice['/Ac/PowerLimit'] = self._setLimit(newTarget, self._maxFeedInPower())
-
       # Grid target limit mode
       if self.settings['/LimitMode'] == 1:
-        if self._inverterAck() == True and self._powerLimitCounter >= self.settings['/GridTargetFastInterval'] * CONTROLLOOPRATE:
+        if self._inverterAck() == True and self._limitAge() >= self.settings['/GridTargetFastInterval']:
           gridSetpoint = self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/AcPowerSetPoint')
           deviation = self._gridPowerFilter - gridSetpoint
          
           if (abs(deviation) > self.settings['/GridTargetFastDeviation'] and self._excessPower == 0) \
           or deviation > self.settings['/GridTargetFastDeviation'] \
-          or (self._powerLimitCounter >= self.settings['/GridTargetSlowInterval'] * CONTROLLOOPRATE and self._excessPower > 0) \
-          or (self._powerLimitCounter >= self.settings['/GridTargetSlowInterval'] * CONTROLLOOPRATE and abs(deviation) > self.settings['/GridTargetSlowDeviation']) \
-          or self._powerLimitCounter >= self.settings['/GridTargetForcedInterval'] * CONTROLLOOPRATE:
+          or (self._limitAge() >= self.settings['/GridTargetSlowInterval'] and self._excessPower > 0) \
+          or (self._limitAge() >= self.settings['/GridTargetSlowInterval'] and abs(deviation) > self.settings['/GridTargetSlowDeviation']) \
+          or self._limitAge() >= self.settings['/GridTargetForcedInterval']:
 
             newTarget = self._dbusservice['/Ac/Power'] + round(self._gridPowerFilter,0) - gridSetpoint
             newTarget = min(newTarget, self._dbusservice['/Ac/MaxPower'])
@@ -798,21 +1014,39 @@ class MicroPlus:
 
       # Base load limit mode
       if self.settings['/LimitMode'] == 2:
-        if (self._gridPower < 0 or self._excessPower > self._actualLimit()) and self._powerLimitCounter >= self.settings['/InverterMinimumInterval'] * CONTROLLOOPRATE:
+        if (self._gridPower < 0 or self._excessPower > self._actualLimit()) and self._limitAge() >= self.settings['/InverterMinimumInterval']:
           newTarget = self._actualLimit() + self._gridPower - 10
-          logging.log(EXTINFO,"set limit1: %s" % (newTarget))
+          events.record(EV_BASELOAD_LIMIT, 1, newTarget)
           self._dbusservice['/Ac/PowerLimit'] = self._setLimit(newTarget, self._maxFeedInPower())
 
-        # 15s interval
-        if self._everySeconds(15):
-          newTarget = min(self._loadPowerMin[0:int(self.settings['/BaseLoadPeriod'] * 4)]) - 10
-          pvOnGrid = (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/PvOnGrid/L1/Power') or 0) + \
-                     (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/PvOnGrid/L2/Power') or 0) + \
-                     (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/PvOnGrid/L3/Power') or 0)
-          newTarget = newTarget - pvOnGrid
-          if newTarget > self._actualLimit():
-            logging.log(EXTINFO,"set limit2: %s" % (newTarget))
-            self._dbusservice['/Ac/PowerLimit'] = self._setLimit(newTarget, self._maxFeedInPower())
+
+  def _maxPowerLoop(self):
+    if self._dbusservice is None:
+        return
+
+    # Maximum power
+    if self._dbusservice['/State'] != 0 and self.settings['/LimitMode'] == 0:
+      newTarget = 0
+      for device in self._devices:
+        newTarget += device.MaxPower
+      self._dbusservice['/Ac/PowerLimit'] = self._setLimit(newTarget, self._maxFeedInPower())
+
+
+  def _baseLoadLoop(self):
+    if self._dbusservice is None:
+        return
+
+    # Base load limit mode
+    if self._dbusservice['/State'] != 0 and self.settings['/LimitMode'] == 2:
+      # lowest load of the 1 s samples in the base load period
+      newTarget = self._loadPowerHistory.min(int(self.settings['/BaseLoadPeriod'] * 60)) - 10
+      pvOnGrid = (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/PvOnGrid/L1/Power') or 0) + \
+                 (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/PvOnGrid/L2/Power') or 0) + \
+                 (self._dbusmonitor.get_value('com.victronenergy.system','/Ac/PvOnGrid/L3/Power') or 0)
+      newTarget = newTarget - pvOnGrid
+      if newTarget > self._actualLimit():
+        events.record(EV_BASELOAD_LIMIT, 2, newTarget)
+        self._dbusservice['/Ac/PowerLimit'] = self._setLimit(newTarget, self._maxFeedInPower())
 
 
   def _calcFeedInExcess(self):
@@ -829,7 +1063,7 @@ class MicroPlus:
       deltaExp = 3
       stepsMax = 30
 
-      pvPowerAvg = sum(self._pvPowerHistory[0:5]) / 5
+      pvPowerAvg = self._pvPowerHistory.mean(5)
       excessMax = (pvPowerAvg - max(self._dbusmonitor.get_value('com.victronenergy.system','/Dc/Battery/Power') or 0, 0)) * 1.1 * self._efficiency()
 
       if self._MpptIsThrottling() == True:
@@ -892,8 +1126,8 @@ class MicroPlus:
         self._checkStartLimit()
       else:
         for device in self._devices:
-          device.PowerLimit = 1
-          device.Active = True
+          device.sendPowerLimit(1)
+          device.setActive(True)
       self._dbusservice['/State'] = 9
       logging.log(EXTINFO,"Inverter start (%s) %s V" % (disableFeedIn, self._dbusservice['/Dc/0/Voltage']))
       if self.settings['/LimitMode'] == 4:
@@ -902,13 +1136,13 @@ class MicroPlus:
     elif disableFeedIn != 0 and self._dbusservice['/State'] != 0:
       logging.log(EXTINFO,"Inverter shutdown (%s) %s V" % (disableFeedIn, self._dbusservice['/Dc/0/Voltage']))
       for device in self._devices:
-        device.Active = False
+        device.setActive(False)
       self._dbusservice['/StartLimit'] = 0
       self._dbusservice['/State'] = 0
 
     elif disableFeedIn == True:
       for device in self._devices:
-        device.Active = False
+        device.setActive(False)
 
 
   def _checkStartLimit(self):    
@@ -923,8 +1157,8 @@ class MicroPlus:
         # Activate all inverter
         for device in self._devices:
           if device.Active == False:
-            device.PowerLimit = 1
-            device.Active = True
+            device.sendPowerLimit(1)
+            device.setActive(True)
         self._dbusservice['/StartLimit'] = 0
         logging.log(EXTINFO,"Start limit off.")
         return False
@@ -935,8 +1169,8 @@ class MicroPlus:
       for device in self._devices:
         if device.Active == False:
           # Activate next inverter
-          device.PowerLimit = 1
-          device.Active = True
+          device.sendPowerLimit(1)
+          device.setActive(True)
           activePower += device.MaxPower
           if activePower >= newLimit:
             break
@@ -945,7 +1179,7 @@ class MicroPlus:
         if device.Active == True:
           if activePower - device.MaxPower > newLimit:
             # Deactivate last inverter
-            device.Active = False
+            device.setActive(False)
             activePower -= device.MaxPower
           else:
             break 
@@ -956,14 +1190,16 @@ class MicroPlus:
 
 
   def _setLimit(self, newLimit, maxFeedInPower):
-    logging.log(EXTINFO,"_setLimit: %s, %s" % (newLimit,maxFeedInPower))
+    events.record(EV_SETLIMIT, newLimit, maxFeedInPower)
     try:
-      if len(self._devices) == 0:
-        logging.log(EXTINFO,"_setLimit: exit no device")
+      # inverters with stale data do not take part in the distribution
+      devices = self._connectedDevices()
+      if len(devices) == 0:
+        events.record(EV_SETLIMIT_NODEVICE)
         return 0
-      primaryMaxPower = self._devices[0].MaxPower
-      primaryMinPower = self._devices[0].MinPower
-      primaryPowerLimit = self._devices[0].PowerLimit
+      primaryMaxPower = devices[0].MaxPower
+      primaryMinPower = devices[0].MinPower
+      primaryPowerLimit = devices[0].PowerLimit
       secondaryMinPower = 0
       secondaryMaxPower = 0
       secondaryPowerLimit = 0
@@ -981,56 +1217,62 @@ class MicroPlus:
       if self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/Hub4Mode') != 3:
         newLimit = min(newLimit, self._dbusmonitor.get_value('com.victronenergy.hub4','/MaxDischargePower'))
 
-      for i in range(1, len(self._devices)):
-        if self._devices[i].Active == True:
-          secondaryMaxPower += self._devices[i].MaxPower
-          secondaryMinPower += self._devices[i].MinPower
-          secondaryPowerLimit += self._devices[i].PowerLimit
+      for i in range(1, len(devices)):
+        if devices[i].Active == True:
+          secondaryMaxPower += devices[i].MaxPower
+          secondaryMinPower += devices[i].MinPower
+          secondaryPowerLimit += devices[i].PowerLimit
 
       if newLimit > primaryMaxPower + secondaryMaxPower and primaryMaxPower + secondaryMaxPower == primaryPowerLimit + secondaryPowerLimit \
         or newLimit ==  primaryPowerLimit + secondaryPowerLimit:
-          logging.log(EXTINFO,"_setLimit: exit no limit change")
+          events.record(EV_SETLIMIT_NOCHANGE, primaryPowerLimit + secondaryPowerLimit)
           return primaryPowerLimit + secondaryPowerLimit
           
-      self._powerLimitCounter = 0
+      self._limitTime = time.monotonic()
       self._limitChangeCounter +=1
+      self._limitChangeTotal +=1
+
+      trace = None
+      if self.settings['/LatencyTrace'] == 1:
+        self._traceId += 1
+        trace = formatTrace(self._traceId, self._gridSampleTime, time.monotonic())
 
       if newLimit >= primaryMaxPower + secondaryMaxPower:
-        for device in self._devices:
+        for device in devices:
           if device.Active == True:
-            limitSet += device.setPowerLimit(device.MaxPower)
+            limitSet += device.setPowerLimit(device.MaxPower, trace)
       
       elif newLimit <= primaryMinPower + secondaryMinPower:
-        for device in self._devices:
+        for device in devices:
           if device.Active == True:
-            limitSet += device.setPowerLimit(device.MinPower)
+            limitSet += device.setPowerLimit(device.MinPower, trace)
 
       else:
         if primaryMaxPower >= newLimit - secondaryPowerLimit and primaryMinPower <= newLimit - secondaryPowerLimit:
-          limitSet += self._devices[0].setPowerLimit(newLimit - secondaryPowerLimit)
+          limitSet += devices[0].setPowerLimit(newLimit - secondaryPowerLimit, trace)
           limitSet += secondaryPowerLimit
         
         elif newLimit <= (primaryMaxPower/2 + secondaryMinPower):
-          for i in range(1, len(self._devices)):
-            if self._devices[i].Active == True:
-              limitSet += self._devices[i].setPowerLimit(self._devices[i].MinPower)
-          limitSet += self._devices[0].setPowerLimit(newLimit - limitSet)
+          for i in range(1, len(devices)):
+            if devices[i].Active == True:
+              limitSet += devices[i].setPowerLimit(devices[i].MinPower, trace)
+          limitSet += devices[0].setPowerLimit(newLimit - limitSet, trace)
         
         elif newLimit >= (primaryMaxPower/2 + secondaryMaxPower):
-          for i in range(1, len(self._devices)):
-            if self._devices[i].Active == True:
-              limitSet += self._devices[i].setPowerLimit(self._devices[i].MaxPower)
-          limitSet += self._devices[0].setPowerLimit(newLimit - limitSet)
+          for i in range(1, len(devices)):
+            if devices[i].Active == True:
+              limitSet += devices[i].setPowerLimit(devices[i].MaxPower, trace)
+          limitSet += devices[0].setPowerLimit(newLimit - limitSet, trace)
         
         else:
-          for i in range(1, len(self._devices)):
-            if self._devices[i].Active == True:
-              p = int((newLimit - primaryMaxPower/2) * self._devices[i].MaxPower / secondaryMaxPower)
-              limitSet += self._devices[i].setPowerLimit(p)
-          limitSet += self._devices[0].setPowerLimit(newLimit - limitSet)
+          for i in range(1, len(devices)):
+            if devices[i].Active == True:
+              p = int((newLimit - primaryMaxPower/2) * devices[i].MaxPower / secondaryMaxPower)
+              limitSet += devices[i].setPowerLimit(p, trace)
+          limitSet += devices[0].setPowerLimit(newLimit - limitSet, trace)
 
       self._debugOut(0, limitSet)
-      logging.log(EXTINFO,"_setLimit: exit new limit %s" % (limitSet))
+      events.record(EV_SETLIMIT_EXIT, limitSet)
       return limitSet
     
     except Exception as e:
@@ -1051,11 +1293,15 @@ class MicroPlus:
 
   def _actualLimit(self):
     actualLimit = 0
-    for device in self._devices:
+    for device in self._connectedDevices():
       actualLimit += device.PowerLimit
     return actualLimit
 
 
+  def _connectedDevices(self):
+    return [device for device in self._devices if device.Connected]
+
+
   def _availablePower(self):
     availablePower = 0
     for device in self._devices:
@@ -1073,7 +1319,7 @@ class MicroPlus:
 
   def _inverterAck(self):
     ack = True
-    for device in self._devices:
+    for device in self._connectedDevices():
         if device.Active == True:
           ack = ack and (device.PowerLimitAck != 0)
     return ack
@@ -1097,29 +1343,60 @@ class MicroPlus:
 
 
   def _refreshAcloads(self):
-    availableAcLoads = []
-    availableInverters = []
-    self._devices = []
-    powerMeterService = None
-    deviceName = ''
+    services = self._dbusmonitor.get_service_list('com.victronenergy.acload')
+    for service in [service for service in self._acloads if service not in services]:
+      self._removeAcload(service)
+    for service in services:
+      if service not in self._acloads:
+        self._addAcload(service)
+    self._acloadsChanged()
+
+
+  def _readAcload(self, service):
+    if self._dbusmonitor.get_value(service,'/CustomName') is None:
+      deviceName = self._dbusmonitor.get_value(service,'/ProductName')
+    else:
+      deviceName = self._dbusmonitor.get_value(service,'/CustomName')
+    instance = self._dbusmonitor.get_value(service,'/DeviceInstance')
+    inverter = self._dbusmonitor.get_value(service,'/Ac/PowerLimit') is not None
+    return (str(deviceName) + ':' + str(instance), instance, inverter)
+
+
+  def _addAcload(self, service):
+    acload = self._readAcload(service)
+    logging.log(EXTINFO,"acload: %s %s" % (service, acload[0]))
+    self._acloads[service] = acload
+    for path, handler in (('/Connected', self._connectedChanged), ('/Enabled', self._enabledChanged), ('/Ac/MaxPower', self._maxPowerChanged)):
+      self._dispatch[(service, path)] = (handler,)
+    if acload[2]:
+      self._addDevice(service, self._dbusmonitor)
+
+
+  def _removeAcload(self, service):
+    logging.log(EXTINFO,"acload removed: %s" % (service))
+    self._acloads.pop(service)
+    for path in ('/Connected', '/Enabled', '/Ac/MaxPower'):
+      self._dispatch.pop((service, path), None)
+    device = self._deviceByService.get(service)
+    if device is not None and device is not self._powerMeter:
+      self._devices.remove(device)
+      self._totals.remove(device)
+      del self._deviceByService[service]
+
+
+  def _updateAcload(self, service):
+    acload = self._readAcload(service)
+    if acload[2] != self._acloads[service][2]:
+      self._removeAcload(service)
+      self._addAcload(service)
+    else:
+      self._acloads[service] = acload
 
-    for service in self._dbusmonitor.get_service_list('com.victronenergy.acload'):
-      logging.log(EXTINFO,"acload: %s %s %s" % (service, self._dbusmonitor.get_value(service,'/CustomName'), self._dbusmonitor.get_value(service,'/DeviceInstance')))
-      if self._dbusmonitor.get_value(service,'/CustomName') is None:
-        deviceName = self._dbusmonitor.get_value(service,'/ProductName')
-      else:
-        deviceName = self._dbusmonitor.get_value(service,'/CustomName')
 
-      if self._dbusmonitor.get_value(service,'/Ac/PowerLimit') is None:
-        availableAcLoads.append(deviceName+':'+str(self._dbusmonitor.get_value(service,'/DeviceInstance')))
-        if self._dbusmonitor.get_value(service,'/DeviceInstance') == self.settings['/PowerMeterInstance'] and self._dbusmonitor.get_value(service,'/Connected') == 1:
-          powerMeterService = service
-      else:
-        availableInverters.append(deviceName+':'+str(self._dbusmonitor.get_value(service,'/DeviceInstance')))
-        self._addDevice(service, self._dbusmonitor)
+  def _acloadsChanged(self):
+    # called after an acload was added, removed or updated
+    self._selectPowerMeter()
 
-    self._powerMeterService = powerMeterService
-    
     if self._dbusservice is None and len(self._devices) > 0:
       self._dbusservice = new_service('com.victronenergy', 'vebus', 'MicroPlus', 'MicroPlus', self._devinst, self._devinst)
       self._initDbusservice()
@@ -1128,15 +1405,45 @@ class MicroPlus:
       self._dbusservice = None
 
     if self._dbusservice is not None:
-      availableAcLoads.sort(key=lambda x: x)
-      availableInverters.sort(key=lambda x: x)
-      self._dbusservice['/AvailableAcLoads'] = availableAcLoads
-      self._dbusservice['/AvailableInverters'] = availableInverters
+      availableAcLoads = sorted(name for name, instance, inverter in self._acloads.values() if not inverter)
+      availableInverters = sorted(name for name, instance, inverter in self._acloads.values() if inverter)
+      if availableAcLoads != self._dbusservice['/AvailableAcLoads']:
+        self._dbusservice['/AvailableAcLoads'] = availableAcLoads
+      if availableInverters != self._dbusservice['/AvailableInverters']:
+        self._dbusservice['/AvailableInverters'] = availableInverters
       self._dbusservice['/Ac/MaxPower'] = self._availablePower()
 
+    if set(self._deviceByService) != self._subscribedDevices:
+      self._updateSubscriptions()
+
+
+  def _selectPowerMeter(self):
+    powerMeterService = None
+    for service, (name, instance, inverter) in self._acloads.items():
+      if not inverter and instance == self.settings['/PowerMeterInstance'] and self._dbusmonitor.get_value(service,'/Connected') == 1:
+        powerMeterService = service
+
+    if powerMeterService == self._powerMeterService:
+      return
+    if self._powerMeterService is not None and self._deviceByService.get(self._powerMeterService) is self._powerMeter:
+      del self._deviceByService[self._powerMeterService]
+    self._powerMeter = None
+    self._powerMeterService = powerMeterService
+    if powerMeterService is not None:
+      self._powerMeter = DbusInverter(powerMeterService, self._dbusmonitor)
+      self._deviceByService[powerMeterService] = self._powerMeter
+
 
   def _addDevice(self,service,dbusmonitor):
-    self._devices.append(DbusInverter(service, dbusmonitor))
+    device = DbusInverter(service, dbusmonitor)
+    self._devices.append(device)
+    self._deviceByService[service] = device
+    self._totals.add(device)
+    self._sortDevices()
+
+
+  def _sortDevices(self):
+    # almost sorted after a change of one inverter, so this is close to O(n)
     self._devices.sort(reverse=True, key=lambda x: x.MaxPower)
 
 
@@ -1164,9 +1471,3 @@ class MicroPlus:
     info['InverterPower'] = int(self._dbusservice['/Ac/Power'])
     
     self._dbusservice['/Info'] = info
-
-  def _everySeconds(self,s):
-    if self._controlLoopCounter % (s * CONTROLLOOPRATE) == 0:
-      return True
-    else:
-      return False
\ No newline at end of file
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+
+# Imported by the forkserver before it forks the inverter and MicroPlus processes. The modules
+# are loaded once and shared copy-on-write, gc.freeze() keeps the garbage collector of the
+# children from touching (and copying) their pages.
+
+# import normal packages
+import gc
+import paho.mqtt
+import paho.mqtt.client
+
+import Inverter
+import MicroPlus
+
+gc.freeze()
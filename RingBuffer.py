@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# import normal packages
+import bisect
+from array import array
+
+
+################################################################################
+#                                                                              #
+#   Ring buffer                                                                #
+#                                                                              #
+################################################################################
+
+class RingBuffer:
+  # fixed size history of numbers. Sums over the last n samples come from a ring of
+  # cumulative sums, the sliding minimum and maximum (minmax=True) from monotonic queues.
+  # append() and sum() are O(1), min() and max() are O(1) over the whole buffer and
+  # O(log size) over the last n samples.
+
+  def __init__(self, size, initial=0, minmax=False):
+    self._size = size
+    self._seq = size              # samples appended so far, including the initial ones
+    # _cum[s % (size+1)] is the sum of the samples 0 .. s-1 since the last rebase
+    self._cum = array('d', [0.0] * (size + 1))
+    for s in range(0, size + 1):
+      self._cum[s % (size + 1)] = initial * s
+    self._minmax = minmax
+    if minmax:
+      self._minSeq = [size - 1]
+      self._minVal = [initial]
+      self._minHead = 0
+      self._maxSeq = [size - 1]
+      self._maxVal = [initial]
+      self._maxHead = 0
+
+
+  def append(self, value):
+    size = self._size
+    seq = self._seq
+    self._cum[(seq + 1) % (size + 1)] = self._cum[seq % (size + 1)] + value
+    self._seq = seq + 1
+
+    if self._seq % size == 0:
+      # keep the cumulative sums small, amortized O(1)
+      base = self._cum[(self._seq - size) % (size + 1)]
+      for i in range(0, size + 1):
+        self._cum[i] -= base
+
+    if self._minmax:
+      self._minHead = self._push(self._minSeq, self._minVal, self._minHead, seq, value, 1)
+      self._maxHead = self._push(self._maxSeq, self._maxVal, self._maxHead, seq, value, -1)
+
+
+  def _push(self, seqs, values, head, seq, value, sign):
+    # drops the samples that can no longer be the minimum (sign 1) or maximum (sign -1)
+    while len(seqs) > head and (values[-1] - value) * sign >= 0:
+      seqs.pop()
+      values.pop()
+    seqs.append(seq)
+    values.append(value)
+    while seqs[head] <= seq - self._size:
+      head += 1
+    if head > self._size:
+      del seqs[:head]
+      del values[:head]
+      head = 0
+    return head
+
+
+  def sum(self, n=None):
+    # sum of the last n samples, all samples if n is None
+    n = self._size if n is None else max(1, min(n, self._size))
+    return self._cum[self._seq % (self._size + 1)] - self._cum[(self._seq - n) % (self._size + 1)]
+
+
+  def mean(self, n=None):
+    n = self._size if n is None else max(1, min(n, self._size))
+    return self.sum(n) / n
+
+
+  def min(self, n=None):
+    return self._window(self._minSeq, self._minVal, self._minHead, n)
+
+
+  def max(self, n=None):
+    return self._window(self._maxSeq, self._maxVal, self._maxHead, n)
+
+
+  def _window(self, seqs, values, head, n):
+    if n is None or n >= self._size:
+      return values[head]
+    return values[bisect.bisect_left(seqs, self._seq - max(1, n), head)]
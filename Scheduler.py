@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import random
+import sys
+import time
+if sys.version_info.major == 2:
+    import gobject
+else:
+    from gi.repository import GLib as gobject
+
+
+################################################################################
+#                                                                              #
+#   Scheduler                                                                  #
+#                                                                              #
+################################################################################
+
+class SchedulerTask:
+
+  def __init__(self, period, callback, phase, jitter):
+    self.period = period
+    self.callback = callback
+    self.jitter = jitter
+    self.misses = 0
+    self._next = time.monotonic() + (period or 0) + phase
+    self.deadline = self._next
+
+
+  def _advance(self, now, tick):
+    if now - self.deadline > tick:
+      # fired more than one tick late
+      self.misses += 1
+    self._next += self.period
+    if self._next <= now:
+      # do not catch up missed periods in a burst
+      self._next = now + self.period
+    self.deadline = self._next
+    if self.jitter > 0:
+      self.deadline += random.uniform(0, self.jitter)
+
+
+class Scheduler:
+
+  def __init__(self, rate):
+    self.rate = rate
+    self.misses = 0
+    self._tasks = []
+    self._timer = None
+    self._lastRun = None
+
+
+  def every(self, period, callback, phase=0, jitter=0):
+    # period None: run on every tick
+    task = SchedulerTask(period, callback, phase, jitter)
+    self._tasks.append(task)
+    return task
+
+
+  def start(self):
+    self.setRate(self.rate)
+
+
+  def stop(self):
+    if self._timer is not None:
+      gobject.source_remove(self._timer)
+      self._timer = None
+
+
+  def setRate(self, rate):
+    self.rate = rate
+    self.stop()
+    self._lastRun = None
+    self._timer = gobject.timeout_add(int(1000 / rate), self._run)
+
+
+  def taskMisses(self):
+    return self.misses + sum(task.misses for task in self._tasks)
+
+
+  def _run(self):
+    timer = self._timer
+    now = time.monotonic()
+    tick = 1 / self.rate
+
+    if self._lastRun is not None and now - self._lastRun > 2 * tick:
+      self.misses += 1
+    self._lastRun = now
+
+    for task in self._tasks:
+      if task.period is not None:
+        if now < task.deadline:
+          continue
+        task._advance(now, tick)
+
+      try:
+        task.callback()
+      except Exception as e:
+        logging.exception('Error at %s', task.callback.__name__, exc_info=e)
+
+      if self._timer != timer:
+        # stopped or rate changed by a task
+        return False
+
+    return True
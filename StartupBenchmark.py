@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Measures the startup of the real inverter and MicroPlus processes, e.g.
+#   python3 StartupBenchmark.py --restarts 3
+# Starts HMpvinverter.py with the config.ini of this directory (MetricsPort must be set) and reads
+# hoymiles_startup_seconds, the time from the fork until the first measured value of each inverter
+# was published, and the resident memory of every process from the metrics endpoint. The
+# inverters only report a startup time once their DTU sends data, stop the installed service
+# before running it.
+
+# import normal packages
+import argparse
+import configparser
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+METRICSLINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def readMetrics(port):
+  # {(name, process, serial): value}
+  values = {}
+  try:
+    with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % (port), timeout=2) as response:
+      body = response.read().decode()
+  except Exception:
+    return None
+  for line in body.splitlines():
+    match = METRICSLINE.match(line)
+    if match is None:
+      continue
+    name, labels, value = match.groups()
+    labels = dict(LABEL.findall(labels or ''))
+    values[(name, labels.get('process'), labels.get('serial'))] = float(value)
+  return values
+
+
+def _order(name):
+  # inverter2 before inverter10
+  match = re.match(r'^(\D*)(\d*)$', name or '')
+  return (match.group(1), int(match.group(2) or 0)) if match else (name, 0)
+
+
+def processes(values):
+  return sorted((process for name, process, serial in values if name == 'hoymiles_process_up' and process is not None), key=_order)
+
+
+def startups(values, process):
+  # {serial: seconds}, serial None for MicroPlus
+  return dict((serial, value) for (name, p, serial), value in values.items() if name == 'hoymiles_startup_seconds' and p == process)
+
+
+def restarts(values, process):
+  return values.get(('hoymiles_process_restarts_total', process, None), 0)
+
+
+def children(pid):
+  result = []
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      with open('/proc/%s/stat' % (entry)) as f:
+        ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+    except Exception:
+      continue
+    if ppid == pid:
+      result.append(int(entry))
+  return result
+
+
+def descendants(pid):
+  result = []
+  for child in children(pid):
+    result.append(child)
+    result.extend(descendants(child))
+  return result
+
+
+def pss(pid):
+  # the resident memory with shared pages divided by the number of processes sharing them
+  try:
+    with open('/proc/%d/smaps_rollup' % (pid)) as f:
+      for line in f:
+        if line.startswith('Pss:'):
+          return int(line.split()[1]) * 1024
+  except Exception:
+    pass
+  return 0
+
+
+def workers(supervisor):
+  # the inverter and MicroPlus processes are the children of the forkserver
+  result = []
+  for pid in children(supervisor):
+    try:
+      with open('/proc/%d/cmdline' % (pid)) as f:
+        cmdline = f.read()
+    except Exception:
+      continue
+    if 'forkserver' in cmdline:
+      result.extend(children(pid))
+  return result
+
+
+def waitStartup(port, inverterCount, run, deadline, expected=None):
+  # until every running process and every inverter reports its startup time, returns the last metrics
+  values = None
+  while time.monotonic() < deadline:
+    time.sleep(0.5)
+    values = readMetrics(port) or values
+    if values is None:
+      continue
+    names = expected or [p for p in processes(values) if values.get(('hoymiles_process_up', p, None)) == 1]
+    if not names or any(restarts(values, p) < run for p in names):
+      continue
+    reported = [startups(values, p) for p in names]
+    if all(reported) and sum(len([s for s in r if s is not None]) for r in reported) >= inverterCount:
+      return values
+  return values
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Measures the startup of the driver processes until their first published value')
+  parser.add_argument('--port', type=int, default=None, help='metrics port (default MetricsPort of config.ini)')
+  parser.add_argument('--restarts', type=int, default=0, choices=range(0, 5), help='processes killed and restarted after the cold start, more than 4 opens the crash loop breaker')
+  parser.add_argument('--wait', type=float, default=120, help='seconds to wait for the startup values')
+  args = parser.parse_args()
+
+  directory = os.path.dirname(os.path.realpath(__file__))
+  config = configparser.ConfigParser()
+  config.read("%s/config.ini" % (directory))
+  inverterCount = 1
+  if config.has_option('DEFAULT', 'InverterCount') == True:
+    inverterCount = int(config["DEFAULT"]["InverterCount"])
+  if args.port is None:
+    if config.has_option('DEFAULT', 'MetricsPort') == False:
+      sys.exit('MetricsPort missing in config.ini')
+    args.port = int(config["DEFAULT"]["MetricsPort"])
+
+  supervisor = subprocess.Popen([sys.executable, os.path.join(directory, 'HMpvinverter.py')], cwd=directory,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    values = waitStartup(args.port, inverterCount, 0, time.monotonic() + args.wait)
+    if values is None:
+      sys.exit('no metrics at port %d' % (args.port))
+    names = processes(values)
+    cold = dict((p, startups(values, p)) for p in names)
+    rss = dict((p, values.get(('hoymiles_process_rss_bytes', p, None))) for p in names + ['supervisor'])
+    # supervisor, forkserver and all children
+    pssTotal = sum(pss(pid) for pid in [supervisor.pid] + descendants(supervisor.pid))
+
+    warm = dict((p, {}) for p in names)
+    for run in range(1, args.restarts + 1):
+      for pid in workers(supervisor.pid):
+        os.kill(pid, signal.SIGTERM)
+      values = waitStartup(args.port, inverterCount, run, time.monotonic() + args.wait, names)
+      for p in names:
+        if restarts(values, p) >= run:
+          for serial, startup in startups(values, p).items():
+            warm[p].setdefault(serial, []).append(startup)
+
+    print('%-12s %6s %8s %26s %9s' % ('process', 'serial', 'cold s', 'restart s min/median/max', 'RSS MiB'))
+    for p in names + ['supervisor']:
+      serials = sorted(set(cold.get(p, {})) | set(warm.get(p, {})), key=_order) or [None]
+      for i, serial in enumerate(serials):
+        startup = cold.get(p, {}).get(serial)
+        times = warm.get(p, {}).get(serial)
+        restart = '-' if not times else '%.2f/%.2f/%.2f' % (min(times), statistics.median(times), max(times))
+        memory = '' if i > 0 else '-' if rss.get(p) is None else '%.1f' % (rss[p] / 1048576)
+        print('%-12s %6s %8s %26s %9s' % (p if i == 0 else '', serial or '', '-' if startup is None else '%.2f' % (startup), restart, memory))
+    print('%-12s %6s %8s %26s %9.1f' % ('total', '', '', '', sum(v for v in rss.values() if v is not None) / 1048576))
+    print('%-12s %6s %8s %26s %9.1f' % ('total PSS', '', '', '', pssTotal / 1048576))
+
+  finally:
+    supervisor.terminate()
+    supervisor.wait()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import time
+from functools import partial
+
+BUSITEM = 'com.victronenergy.BusItem'
+DBUSINTERFACE = 'org.freedesktop.DBus'
+DBUSPATH = '/org/freedesktop/DBus'
+
+
+################################################################################
+#                                                                              #
+#   D-Bus subscriptions                                                        #
+#                                                                              #
+################################################################################
+
+class DbusSubscriptions:
+  # replaces the bus wide PropertiesChanged and ItemsChanged matches of a DbusMonitor by
+  # matches for the services in use. The signals are handed to the DbusMonitor handlers,
+  # so its cache and valueChangedCallback work as before for the subscribed services.
+
+  def __init__(self, dbusmonitor, paths=()):
+    # paths: PropertiesChanged of these paths is received from all services
+    self._monitor = dbusmonitor
+    self._subscriptions = {}      # service -> (paths, [SignalMatch])
+    self._owners = {}             # service -> unique name of the services subscribed as a whole
+    self._serviceIds = set()      # unique names of self._owners
+    self.signals = 0
+    self.handlerTime = 0
+    self.enabled = False
+
+    if not all(hasattr(dbusmonitor, attr) for attr in ('dbusConn', 'handler_value_changes', 'handler_item_changes')):
+      logging.warning("DbusMonitor without signal handlers, keeping the bus wide signal matches")
+      return
+
+    self._bus = dbusmonitor.dbusConn
+    self._bus.remove_signal_receiver(dbusmonitor.handler_value_changes, signal_name='PropertiesChanged', dbus_interface=BUSITEM)
+    self._bus.remove_signal_receiver(dbusmonitor.handler_item_changes, signal_name='ItemsChanged', dbus_interface=BUSITEM, path='/')
+    for path in paths:
+      self._bus.add_signal_receiver(self._onPathValue, dbus_interface=BUSITEM, signal_name='PropertiesChanged',
+        path=path, path_keyword='path', sender_keyword='senderId')
+    self.enabled = True
+
+
+  def subscribe(self, services):
+    # services: {service: None for all paths or a list of paths}
+    if not self.enabled:
+      return
+    for service in list(self._subscriptions):
+      if service not in services or services[service] != self._subscriptions[service][0]:
+        self._unsubscribe(service)
+
+    added = []
+    for service, paths in services.items():
+      if service in self._subscriptions:
+        continue
+      matches = []
+      if paths is None:
+        matches.append(self._bus.add_signal_receiver(self._onValue, dbus_interface=BUSITEM, signal_name='PropertiesChanged',
+          bus_name=service, path_keyword='path', sender_keyword='senderId'))
+        matches.append(self._bus.add_signal_receiver(self._onItems, dbus_interface=BUSITEM, signal_name='ItemsChanged',
+          bus_name=service, path='/', sender_keyword='senderId'))
+        # a restarted service has a new unique name
+        matches.append(self._bus.add_signal_receiver(partial(self._onOwnerChanged, service), dbus_interface=DBUSINTERFACE,
+          signal_name='NameOwnerChanged', bus_name=DBUSINTERFACE, arg0=service))
+      else:
+        for path in paths:
+          matches.append(self._bus.add_signal_receiver(self._onValue, dbus_interface=BUSITEM, signal_name='PropertiesChanged',
+            bus_name=service, path=path, path_keyword='path', sender_keyword='senderId'))
+        # services may also send their changes in one ItemsChanged
+        matches.append(self._bus.add_signal_receiver(partial(self._onPathItems, frozenset(paths)), dbus_interface=BUSITEM,
+          signal_name='ItemsChanged', bus_name=service, path='/', sender_keyword='senderId'))
+      self._subscriptions[service] = (paths, matches)
+      added.append(service)
+      logging.debug("subscribed %s %s" % (service, 'all paths' if paths is None else len(paths)))
+
+    # changes while the service was not subscribed were missed
+    for service in added:
+      self._refresh(service, self._subscriptions[service][0])
+
+
+  def _refresh(self, service, paths):
+    # all calls are asynchronous, a slow service does not block the main loop
+    self._bus.call_async(DBUSINTERFACE, DBUSPATH, DBUSINTERFACE, 'GetNameOwner', 's', [service],
+      partial(self._onRefreshOwner, service, paths), partial(self._onRefreshError, service))
+
+
+  def _onRefreshOwner(self, service, paths, owner):
+    if not self._subscribed(service, paths):
+      return
+    if paths is None:
+      self._setOwner(service, owner)
+    self._bus.call_async(service, '/', BUSITEM, 'GetItems', '', [],
+      partial(self._onRefreshItems, service, paths, owner), partial(self._onRefreshItemsError, service, paths, owner))
+
+
+  def _onRefreshItems(self, service, paths, owner, items):
+    if not self._subscribed(service, paths):
+      return
+    if paths is not None:
+      items = {path: item for path, item in items.items() if path in paths}
+    self._monitor.handler_item_changes(items, owner)
+
+
+  def _onRefreshItemsError(self, service, paths, owner, e):
+    # services without GetItems
+    for path in paths or ():
+      self._bus.call_async(service, path, BUSITEM, 'GetValue', '', [],
+        partial(self._onRefreshValue, service, paths, path, owner), partial(self._onRefreshError, service))
+
+
+  def _onRefreshValue(self, service, paths, path, owner, value):
+    if self._subscribed(service, paths):
+      self._monitor.handler_item_changes({path: {'Value': value}}, owner)
+
+
+  def _onRefreshError(self, service, e):
+    logging.debug("refresh of %s failed: %s" % (service, e))
+
+
+  def _subscribed(self, service, paths):
+    # the subscription may have changed until the reply arrived
+    return service in self._subscriptions and self._subscriptions[service][0] == paths
+
+
+  def _setOwner(self, service, owner):
+    if owner:
+      self._owners[service] = owner
+    else:
+      self._owners.pop(service, None)
+    self._serviceIds = set(self._owners.values())
+
+
+  def _onOwnerChanged(self, service, name, oldOwner, newOwner):
+    if service in self._subscriptions:
+      self._setOwner(service, newOwner)
+
+
+  def _unsubscribe(self, service):
+    paths, matches = self._subscriptions.pop(service)
+    for match in matches:
+      match.remove()
+    if service in self._owners:
+      self._setOwner(service, None)
+    logging.debug("unsubscribed %s" % (service))
+
+
+  def _onValue(self, changes, path=None, senderId=None):
+    start = time.perf_counter()
+    self.signals += 1
+    self._monitor.handler_value_changes(changes, path, senderId)
+    self.handlerTime += time.perf_counter() - start
+
+
+  def _onPathValue(self, changes, path=None, senderId=None):
+    # already received through the subscription of the whole service
+    if senderId in self._serviceIds:
+      return
+    self._onValue(changes, path, senderId)
+
+
+  def _onPathItems(self, paths, items, senderId=None):
+    items = {path: item for path, item in items.items() if path in paths}
+    if items:
+      self._onItems(items, senderId)
+
+
+  def _onItems(self, items, senderId=None):
+    start = time.perf_counter()
+    self.signals += 1
+    self._monitor.handler_item_changes(items, senderId)
+    self.handlerTime += time.perf_counter() - start
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import time
+from collections import deque
+
+# time.monotonic() is CLOCK_MONOTONIC on Linux and can be compared between processes
+TRACESTAGES = ['decision', 'dbus', 'publish', 'ack', 'settle', 'total']
+TRACEBUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000] # ms, last bucket is open
+TRACETIMEOUT = 60
+TRACERECORDS = 500
+
+
+def formatTrace(traceId, sampleTime, decisionTime):
+  return '%d:%.6f:%.6f' % (traceId, sampleTime, decisionTime)
+
+
+################################################################################
+#                                                                              #
+#   Latency trace                                                              #
+#                                                                              #
+################################################################################
+
+class LatencyTrace:
+
+  def __init__(self):
+    self._histogram = {}
+    for stage in TRACESTAGES:
+      self._histogram[stage] = [0] * (len(TRACEBUCKETS) + 1)
+    self._records = deque(maxlen=TRACERECORDS)
+    self._current = None
+    self.completed = 0
+
+
+  def start(self, value):
+    # value written by MicroPlus: '<id>:<sample time>:<decision time>'
+    try:
+      traceId, sample, decision = value.split(':')
+      self._current = {'id': int(traceId), 'sample': float(sample), 'decision': float(decision), 'limit': None}
+    except Exception:
+      self._current = None
+
+
+  def stamp(self, hop, limit=None):
+    if self._current is None or hop in self._current:
+      return
+    now = time.monotonic()
+    if now - self._current['decision'] > TRACETIMEOUT:
+      self._current = None
+      return
+    self._current[hop] = now
+    if limit is not None:
+      self._current['limit'] = limit
+
+
+  def settled(self, power):
+    if self._current is None or 'publish' not in self._current or self._current['limit'] is None:
+      return False
+    limit = self._current['limit']
+    if abs(power - limit) > max(10, limit * 0.05):
+      return False
+    self.stamp('settle')
+    if self._current is None:
+      return False
+    self._complete()
+    return True
+
+
+  def _complete(self):
+    t = self._current
+    self._current = None
+    if 'delivery' not in t:
+      return
+    # OpenDTU does not acknowledge limits
+    t.setdefault('ack', t['publish'])
+    record = {
+      'id': t['id'],
+      'limit': t['limit'],
+      'decision': t['decision'] - t['sample'],
+      'dbus': t['delivery'] - t['decision'],
+      'publish': t['publish'] - t['delivery'],
+      'ack': t['ack'] - t['publish'],
+      'settle': t['settle'] - t['ack'],
+      'total': t['settle'] - t['sample'],
+    }
+    for stage in TRACESTAGES:
+      self._histogram[stage][self._bucket(record[stage] * 1000)] += 1
+    self._records.append(record)
+    self.completed += 1
+
+
+  def _bucket(self, ms):
+    for i, limit in enumerate(TRACEBUCKETS):
+      if ms <= limit:
+        return i
+    return len(TRACEBUCKETS)
+
+
+  def histogram(self):
+    return dict((stage, list(counts)) for stage, counts in self._histogram.items())
+
+
+  def dump(self, filename):
+    try:
+      with open(filename, 'w') as f:
+        f.write('id,limit,' + ','.join(TRACESTAGES) + '\n')
+        for r in self._records:
+          f.write('%d,%s,' % (r['id'], r['limit']) + ','.join('%.1f' % (r[stage] * 1000) for stage in TRACESTAGES) + '\n')
+      logging.info("Latency trace written to %s" % (filename))
+    except Exception as e:
+      logging.exception('Error at %s', 'dump', exc_info=e)
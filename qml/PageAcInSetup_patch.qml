@@ -94,12 +94,13 @@
 			editable: true
 			possibleValues:[
 				MbOption{description: qsTr("Ahoy"); value: 0 },
-				MbOption{description: qsTr("OpenDTU"); value: 1 }
+				MbOption{description: qsTr("OpenDTU"); value: 1 },
+				MbOption{description: qsTr("Ahoy JSON"); value: 2 }
 			]
 		}
 
 		MbSpinBox {
-			show: productId == 0xfff1 && microEssDtu.value === 0
+			show: productId == 0xfff1 && (microEssDtu.value === 0 || microEssDtu.value === 2)
 			description: qsTr("Inverter ID")
 			item {
 				bind: Utils.path("com.victronenergy.settings/Settings/Devices/mInv_", serialMicroEss.value, "/InverterID")
@@ -131,4 +132,11 @@
 			name: qsTr("Use AC Calibration")
 			show: valid && powerCalibrationValues.value != ""
 		}
+
+		MbSwitch {
+			id: powerAutoCalibration
+			bind: Utils.path(root.bindPrefix, "/Ac/AutoCalibration")
+			name: qsTr("Learn AC Calibration")
+			show: valid
+		}
 /* HM settings end */